@@ -25,6 +25,10 @@
 # **************************************************************************
 
 import os
+import json
+import shlex
+import threading
+import subprocess
 import pwem
 import pyworkflow.utils as pwutils
 from pyworkflow import Config
@@ -32,7 +36,7 @@ from pyworkflow import Config
 from .constants import *
 
 
-__version__ = '3.13'
+__version__ = '3.14'
 _references = ['Zhong2020', 'Zhong2021', 'Zhong2021b', 'Kinman2022']
 _logo = "cryodrgn_logo.png"
 
@@ -40,10 +44,14 @@ _logo = "cryodrgn_logo.png"
 class Plugin(pwem.Plugin):
     _url = "https://github.com/scipion-em/scipion-em-cryodrgn"
     _supportedVersions = VERSIONS
+    _resolvedEnvs = dict()
+    _resolveLock = threading.Lock()
 
     @classmethod
     def _defineVariables(cls):
         cls._defineVar(CRYODRGN_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
+        cls._defineVar(CRYODRGN_VOLUME_CACHE, DEFAULT_VOLUME_CACHE)
+        cls._defineVar(CRYODRGN_VOLUME_CACHE_SIZE, 0)
 
     @classmethod
     def getCryoDrgnEnvActivation(cls):
@@ -113,10 +121,112 @@ class Plugin(pwem.Plugin):
     @classmethod
     def getProgram(cls, program, gpus='0'):
         """ Create cryoDRGN command line. """
-        fullProgram = '%s && CUDA_VISIBLE_DEVICES=%s cryodrgn %s' % (
-            cls.getActivationCmd(), gpus, program)
+        return cls.getEnvCommand(f"cryodrgn {program}", gpus)
 
-        return fullProgram
+    @classmethod
+    def getPythonProgram(cls, script, gpus='0'):
+        """ Create a command line to run a plugin script
+        with python from the cryoDRGN environment. """
+        scriptFn = os.path.join(os.path.dirname(__file__), 'scripts', script)
+        return cls.getEnvCommand(f"python {scriptFn}", gpus)
+
+    @classmethod
+    def getEnvCommand(cls, command, gpus=None):
+        """ Create a command line that runs an executable of the cryoDRGN
+        environment. The variables set by conda activation are resolved
+        once per version and cached, the activation command is only used
+        when they can not be resolved. """
+        gpuVar = '' if gpus is None else f'CUDA_VISIBLE_DEVICES={gpus} '
+        resolved = cls.getResolvedEnv()
+        if resolved is None:
+            return f"{cls.getActivationCmd()} && {gpuVar}{command}"
+
+        exe, _, args = command.partition(' ')
+        envVars = ' '.join(f"{key}={shlex.quote(value)}"
+                           for key, value in resolved['environ'].items())
+        exe = shlex.quote(os.path.join(resolved['bin'], exe))
+
+        return f"{envVars} {gpuVar}{exe} {args}"
+
+    @classmethod
+    def getResolvedEnv(cls):
+        """ Return the variables set by activating the environment of the
+        active version and its bin folder, or None if they can not be
+        resolved. Cached values are refreshed if the activation command
+        changed, the environment executables are gone or the cache file
+        is unreadable. """
+        version = cls.getActiveVersion()
+        cacheFn = os.path.expanduser(ENV_CACHE % version)
+
+        # threads of the same process (e.g. one per device) resolve once
+        with cls._resolveLock:
+            resolved = cls._resolvedEnvs.get(version)
+            if resolved is None:
+                try:
+                    with open(cacheFn) as f:
+                        resolved = json.load(f)
+                except (OSError, ValueError):  # missing or truncated file
+                    resolved = None
+
+            if not cls._isEnvValid(resolved):
+                resolved = cls._resolveEnv()
+                if resolved is None:
+                    return None
+                cls._writeEnvCache(cacheFn, resolved)
+
+            cls._resolvedEnvs[version] = resolved
+
+        return resolved
+
+    @classmethod
+    def _isEnvValid(cls, resolved):
+        try:
+            return (resolved['activation'] == cls.getActivationCmd() and
+                    isinstance(resolved['environ'], dict) and
+                    all(os.path.exists(os.path.join(resolved['bin'], exe))
+                        for exe in ['cryodrgn', 'python']))
+        except (KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def _writeEnvCache(cacheFn, resolved):
+        """ Write through a temporary file, so that other processes
+        never read a partial cache. """
+        tmpFn = f"{cacheFn}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cacheFn), exist_ok=True)
+            with open(tmpFn, 'w') as f:
+                json.dump(resolved, f, indent=2)
+            os.replace(tmpFn, cacheFn)
+        except OSError:  # not cached, resolved again by the next process
+            pass
+
+    @classmethod
+    def _resolveEnv(cls):
+        """ Activate the environment once and keep the variables
+        that activation added or changed. """
+        printEnv = "python -c 'import json, os; print(json.dumps(dict(os.environ)))'"
+        environ = cls.getEnviron()
+        try:
+            result = subprocess.run(f"{cls.getActivationCmd()} && {printEnv}",
+                                    shell=True, env=environ, check=True,
+                                    capture_output=True, text=True, timeout=300)
+            activated = json.loads(result.stdout.strip().splitlines()[-1])
+        except (subprocess.SubprocessError, ValueError, IndexError):
+            return None
+
+        ignored = {'_', 'PWD', 'OLDPWD', 'SHLVL'}
+        changed = {key: value for key, value in activated.items()
+                   if key not in ignored and key.isidentifier()
+                   and environ.get(key) != value}
+        if 'CONDA_PREFIX' not in changed:
+            return None
+
+        return {
+            'activation': cls.getActivationCmd(),
+            'bin': os.path.join(changed['CONDA_PREFIX'], 'bin'),
+            'environ': changed
+        }
 
     @classmethod
     def getActiveVersion(cls, *args):
@@ -39,6 +39,10 @@ CRYODRGN_DEFAULT_VER_NUM = V3_4_0
 DEFAULT_ENV_NAME = getCryoDrgnEnvName(CRYODRGN_DEFAULT_VER_NUM)
 DEFAULT_ACTIVATION_CMD = 'conda activate ' + DEFAULT_ENV_NAME
 CRYODRGN_ENV_ACTIVATION = 'CRYODRGN_ENV_ACTIVATION'
+CRYODRGN_VOLUME_CACHE = 'CRYODRGN_VOLUME_CACHE'
+CRYODRGN_VOLUME_CACHE_SIZE = 'CRYODRGN_VOLUME_CACHE_SIZE'
+DEFAULT_VOLUME_CACHE = '~/.cache/scipion-cryodrgn/volumes'
+ENV_CACHE = '~/.cache/scipion-cryodrgn/environ-%s.json'
 
 # Viewer constants
 EPOCH_LAST = 0
@@ -46,11 +50,36 @@ EPOCH_SELECTION = 1
 
 VOLUME_SLICES = 0
 VOLUME_CHIMERA = 1
+VOLUME_THUMBNAILS = 2
 
 # extra metadata attrs
 Z_VALUES = "_cryodrgnZValues"
 WEIGHTS = "_cryodrgnWeights"
 CONFIG = "_cryodrgnConfig"
+KMEANS_LABEL = "_cryodrgnKmeansLabel"
+UMAP_COORD = "_cryodrgnUmap%d"
+PCA_COORD = "_cryodrgnPc%d"
+KNN_DIST = "_cryodrgnKnnDist"
+DENSITY = "_cryodrgnDensity"
+Z_NORM = "_cryodrgnZNorm"
+
+# latent space analysis backend
+ANALYSIS_CRYODRGN = 0
+ANALYSIS_SCALABLE = 1
+
+# trajectory sampling
+TRAJECTORY_UNIFORM = 0
+TRAJECTORY_ADAPTIVE = 1
+
+# latent subset queries
+QUERY_VOLUMES = 0
+QUERY_COORDINATES = 1
+QUERY_NEAREST = 0
+QUERY_RADIUS = 1
+
+# particle filtering cutoffs
+CUTOFF_QUANTILE = 0
+CUTOFF_VALUE = 1
 
 # ab initio type
 AB_INITIO_HOMO = 0
@@ -0,0 +1,131 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+
+
+CHUNK_SIZE = 1000000
+
+
+def makeDensityTiles(coords, fn, levels=(64, 128, 256, 512, 1024)):
+    """ Save 2D histograms of coords at several resolutions, accumulated
+    in chunks, together with their common extent. """
+    extent = np.array([coords[:, 0].min(), coords[:, 0].max(),
+                       coords[:, 1].min(), coords[:, 1].max()], dtype=float)
+    edges = {bins: (np.linspace(extent[0], extent[1], bins + 1),
+                    np.linspace(extent[2], extent[3], bins + 1))
+             for bins in levels}
+    tiles = {bins: np.zeros((bins, bins), dtype=np.int64) for bins in levels}
+
+    for start in range(0, len(coords), CHUNK_SIZE):
+        chunk = np.asarray(coords[start:start + CHUNK_SIZE])
+        for bins in levels:
+            tiles[bins] += np.histogram2d(chunk[:, 0], chunk[:, 1],
+                                          bins=edges[bins])[0].astype(np.int64)
+
+    np.savez(fn, extent=extent,
+             **{f"level_{bins}": tiles[bins] for bins in levels})
+
+
+class LatentDensityExplorer:
+    """
+    Interactive density map of 2D latent coordinates (UMAP or PCA).
+    Densities are drawn from the precomputed histogram level that best
+    matches the zoom, so rendering time does not depend on the number of
+    particles. A lasso selection gives the indices of the enclosed
+    particles to the onSubset callback.
+    """
+    TARGET_BINS = 400  # bins across the view
+
+    def __init__(self, tilesFn, coordsFn, onSubset, title=""):
+        tiles = np.load(tilesFn)
+        self.extent = tiles['extent']
+        self.levels = {int(key.split('_')[1]): tiles[key]
+                       for key in tiles.files if key.startswith('level_')}
+        self.coords = np.load(coordsFn, mmap_mode='r')
+        self.onSubset = onSubset
+        self.title = title
+        self.selection = np.empty(0, dtype=np.int64)
+        self.bins = None
+
+    def show(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import LassoSelector, Button
+
+        fig, self.ax = plt.subplots(figsize=(7, 7))
+        fig.subplots_adjust(bottom=0.12)
+        self.image = self.ax.imshow(np.zeros((2, 2)), origin='lower',
+                                    extent=self.extent, aspect='auto',
+                                    cmap='viridis', interpolation='nearest')
+        self.outline, = self.ax.plot([], [], color='red', linewidth=1)
+        self._setLevel(min(self.levels))
+        self._onZoom()
+        self.ax.callbacks.connect('xlim_changed', self._onZoom)
+        self.ax.callbacks.connect('ylim_changed', self._onZoom)
+
+        self.lasso = LassoSelector(self.ax, self._onSelect)
+        self.button = Button(fig.add_axes([0.7, 0.02, 0.25, 0.06]),
+                             'Create subset')
+        self.button.on_clicked(self._onCreate)
+        self._updateTitle()
+        plt.show()
+
+    def _setLevel(self, bins):
+        if bins != self.bins:
+            self.bins = bins
+            self.image.set_data(np.log1p(self.levels[bins].T))
+            self.image.autoscale()
+
+    def _onZoom(self, ax=None):
+        """ Use the coarsest level with enough bins across the view. """
+        x0, x1 = self.ax.get_xlim()
+        fraction = abs(x1 - x0) / max(self.extent[1] - self.extent[0], 1e-12)
+        levels = sorted(self.levels)
+        bins = next((b for b in levels if b * fraction >= self.TARGET_BINS),
+                    levels[-1])
+        self._setLevel(bins)
+        self.ax.figure.canvas.draw_idle()
+
+    def _onSelect(self, vertices):
+        from matplotlib.path import Path
+        path = Path(vertices)
+        selected = [start + np.flatnonzero(path.contains_points(
+                        np.asarray(self.coords[start:start + CHUNK_SIZE])))
+                    for start in range(0, len(self.coords), CHUNK_SIZE)]
+        self.selection = np.concatenate(selected)
+        closed = np.vstack([vertices, vertices[:1]])
+        self.outline.set_data(closed[:, 0], closed[:, 1])
+        self._updateTitle()
+        self.ax.figure.canvas.draw_idle()
+
+    def _onCreate(self, event):
+        if len(self.selection):
+            self.onSubset(self.selection.tolist())
+
+    def _updateTitle(self):
+        self.ax.set_title(f"{self.title}\n{len(self.selection)} of "
+                          f"{len(self.coords)} particles selected")
@@ -29,3 +29,7 @@ from .protocol_train import CryoDrgnProtTrain
 from .protocol_abinitio import CryoDrgnProtAbinitio
 from .protocol_analyze import CryoDrgnProtAnalyze
 from .protocol_subset import CryoDrgnProtSubset
+from .protocol_convergence import CryoDrgnProtConvergence
+from .protocol_transform_volumes import CryoDrgnProtTransformVolumes
+from .protocol_latent_subset import CryoDrgnProtLatentSubset
+from .protocol_filter import CryoDrgnProtFilter
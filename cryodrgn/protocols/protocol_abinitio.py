@@ -149,6 +149,3 @@ class CryoDrgnProtAbinitio(CryoDrgnProtBase):
             args.append(self.extraParams.get())
 
         return args
-
-    def _getRun(self):
-        return self.continueRun.get() if self.doContinue else self
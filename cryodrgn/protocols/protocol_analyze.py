@@ -27,25 +27,40 @@
 # **************************************************************************
 
 import os
+import json
+import pickle
 import numpy as np
 from enum import Enum
 
 import pyworkflow.utils as pwutils
 import pyworkflow.protocol.params as params
 from pyworkflow.constants import NEW
+from pyworkflow.protocol import STEPS_PARALLEL
 import pyworkflow.object as pwobj
 from pwem.protocols import ProtAnalysis3D
-from pwem.objects import SetOfVolumes, Volume
+from pwem.objects import (SetOfVolumes, Volume, SetOfParticlesFlex,
+                          SetOfClasses3D)
 from pwem.emlib.image import ImageHandler, DT_FLOAT
 
 from cryodrgn import Plugin
 from cryodrgn.constants import (EPOCH_LAST, EPOCH_SELECTION, Z_VALUES,
-                                AB_INITIO_HOMO, CLUSTER_WARD, V3_3_2)
+                                AB_INITIO_HOMO, CLUSTER_WARD, CRYODRGN,
+                                ANALYSIS_CRYODRGN, ANALYSIS_SCALABLE,
+                                KMEANS_LABEL, UMAP_COORD, PCA_COORD,
+                                TRAJECTORY_UNIFORM, TRAJECTORY_ADAPTIVE,
+                                V3_3_2, V3_4_0)
 from cryodrgn.protocols.protocol_base import CryoDrgnProtBase
+from cryodrgn.explorer import makeDensityTiles
+from cryodrgn.utils import (stackVolumes, getVolumeStackName,
+                            generateAdaptiveTrajectory, makeThumbnails,
+                            makeProxies, getVolumeLocations, getThumbnailName,
+                            getProxyName)
 
 
 class outputs(Enum):
     Volumes = SetOfVolumes
+    Particles = SetOfParticlesFlex
+    Classes = SetOfClasses3D
 
 
 class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
@@ -54,22 +69,44 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
     _label = "analyze results"
     _devStatus = NEW
     _possibleOutputs = outputs
+    stepsExecutionMode = STEPS_PARALLEL
 
     def _createFilenameTemplates(self):
         """ Centralize how files are called within the protocol. """
         out = lambda p: self.getOutputDir(f'analyze.{self._epoch}', p)
+        landscape = lambda p: self.getOutputDir(f'landscape.{self._epoch}', p)
+        states = lambda p: self._getExtraPath('states', p)
 
         myDict = {
             'input_mask': self._getExtraPath("input_mask.mrc"),
+            'manifest': self._getExtraPath("manifest.json"),
             'output_vol': out('vol_%(id)03d.mrc'),
             'output_volN': out('kmeans%(ksamples)d/vol_%(id)03d.mrc'),
             'z_values': out('z_values.txt'),
             'z_valuesN': out('kmeans%(ksamples)d/z_values.txt'),
+            'kmeans_dir': out('kmeans%(ksamples)d'),
+            'kmeans_z': out('kmeans%(ksamples)d/centers.txt'),
             'kmeans_centers': out('kmeans%(ksamples)d/centers_ind.txt'),
+            'kmeans_labels': out('kmeans%(ksamples)d/labels.pkl'),
             'graph_path': out('graph_traversal/path.txt'),
             'graph_pathZ': out('graph_traversal/z.path.txt'),
             'graph_vols': out('graph_traversal'),
-            'umaps': out('umap.pkl')
+            'pc_dir': out('pc%(pc)d'),
+            'pc_z': out('pc%(pc)d/z_values.txt'),
+            'umaps': out('umap.pkl'),
+            'pc_projections': out('pc_projections.npy'),
+            'analyze_dir': out(''),
+            'notebook': out('cryoDRGN_filtering.ipynb'),
+            'landscape_dir': landscape(''),
+            'landscape_kmeans_dir': landscape('kmeans%(numVols)d'),
+            'landscape_kmeans_z': landscape('kmeans%(numVols)d/centers.txt'),
+            'landscape_kmeans_labels': landscape('kmeans%(numVols)d/labels.pkl'),
+            'landscape_state_labels': landscape('clustering_L2_%(linkage)s_%(clusters)d/state_labels.pkl'),
+            'explorer_coords': self._getExtraPath('explorer', '%(space)s_coords.npy'),
+            'explorer_tiles': self._getExtraPath('explorer', '%(space)s_tiles.npz'),
+            'state_ind': states('state_%(state)02d_particle_ind.pkl'),
+            'state_dir': states('state_%(state)02d'),
+            'state_vol': states('state_%(state)02d/backproject.mrc')
         }
         self._updateFilenamesDict(myDict)
 
@@ -81,7 +118,10 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                        help="GPU may have several cores. Set it to zero"
                             " if you do not know what we are talking about."
                             " First core index is 0, second 1 and so on."
-                            " You can use only a single GPU.")
+                            " Volumes to generate are split in batches, "
+                            "one per GPU, decoded concurrently and gathered "
+                            "in their usual folders. UMAP, PCA and "
+                            "clustering run on CPU.")
         form.addParam('inputProt', params.PointerParam, important=True,
                       pointerClass='CryoDrgnProtTrain, CryoDrgnProtAbinitio',
                       label="Previous run to analyse")
@@ -104,6 +144,31 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                       label="Downsample volumes?")
         form.addParam('boxSize', params.IntParam, default=128,
                       condition='doDownsample', label="New box size (px)")
+        form.addParam('doStack', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Write one volume stack per group?",
+                      help="Consolidate the volumes of each group (k-means "
+                           "samples, each PC traversal, graph traversal and "
+                           "landscape volumes) into a single *volumes.mrcs* "
+                           "stack instead of one file per volume. Useful "
+                           "on network file systems.")
+
+        form.addParam('doThumbnails', params.BooleanParam, default=True,
+                      label="Create volume thumbnails?",
+                      help="Render central slices and projections of every "
+                           "generated volume into PNG mosaics, a quick "
+                           "overview in the viewer without loading the "
+                           "full maps.")
+
+        form.addParam('doProxies', params.BooleanParam, default=False,
+                      label="Create low resolution proxies?",
+                      help="Write Fourier cropped copies of the k-means, PC "
+                           "and graph traversal volumes. The viewer opens "
+                           "these proxies as the ChimeraX series and loads "
+                           "full resolution maps only for selected frames.")
+        form.addParam('proxyBoxSize', params.IntParam, default=64,
+                      condition='doProxies',
+                      label="Proxy box size (px)")
 
         form.addSection(label='Latent space')
         form.addParam('doGraphTraversal', params.BooleanParam, default=False,
@@ -116,9 +181,43 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                            "remaining on the data manifold since we don't want "
                            "to generate structures from unoccupied regions of "
                            "the latent space.")
+        form.addParam('traversalBackend', params.EnumParam,
+                      choices=['cryodrgn', 'scalable'],
+                      default=ANALYSIS_CRYODRGN,
+                      condition='doGraphTraversal',
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Graph traversal with",
+                      help="*cryodrgn*: run *cryodrgn graph_traversal* "
+                           "(exact neighbor graph).\n"
+                           "*scalable*: build an approximate nearest "
+                           "neighbor graph with a KD-tree queried in "
+                           "parallel chunks, stored as a sparse matrix.")
         form.addParam('pc', params.IntParam, default=2,
                       label="Number of principal components",
                       help="Number of principal component traversals to generate.")
+        form.addParam('trajectorySampling', params.EnumParam,
+                      choices=['uniform', 'adaptive'],
+                      default=TRAJECTORY_UNIFORM,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Trajectory volumes sampling",
+                      help="How volumes along PC and graph traversals are "
+                           "placed.\n"
+                           "*uniform*: at the evenly spaced points of the "
+                           "trajectory.\n"
+                           "*adaptive*: start with a few evenly spaced "
+                           "points and bisect between neighbor volumes that "
+                           "differ by more than the tolerance, until the "
+                           "volume budget is reached. Fewer volumes are "
+                           "decoded where the map barely changes, more where "
+                           "it changes abruptly.")
+        form.addParam('trajectoryBudget', params.IntParam, default=20,
+                      condition='trajectorySampling==%d' % TRAJECTORY_ADAPTIVE,
+                      label="Maximum volumes per trajectory")
+        form.addParam('trajectoryTolerance', params.FloatParam, default=0.05,
+                      condition='trajectorySampling==%d' % TRAJECTORY_ADAPTIVE,
+                      label="Tolerance",
+                      help="Maximum relative L2 difference allowed between "
+                           "neighbor volumes.")
         form.addParam('ksamples', params.IntParam, default=20,
                       label='Number of K-means samples to generate',
                       help="*cryodrgn analyze* uses the k-means clustering "
@@ -127,6 +226,39 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                            "density map from the center of each of these "
                            "regions. The goal is to provide a tractable number "
                            "of representative density maps to visually inspect.")
+        form.addParam('analysisBackend', params.EnumParam,
+                      choices=['cryodrgn', 'scalable'],
+                      default=ANALYSIS_CRYODRGN,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Latent space analysis with",
+                      help="*cryodrgn*: run *cryodrgn analyze* (exact UMAP "
+                           "and k-means on all particles).\n"
+                           "*scalable*: for millions of particles. Uses "
+                           "mini-batch k-means and incremental PCA on the "
+                           "memory-mapped z matrix, fits UMAP on a "
+                           "stratified subsample and projects the remaining "
+                           "particles in parallel chunks.")
+        form.addParam('umapSample', params.IntParam, default=100000,
+                      condition='analysisBackend==%d' % ANALYSIS_SCALABLE,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Particles used to fit UMAP")
+        form.addParam('chunkSize', params.IntParam, default=100000,
+                      condition='analysisBackend==%d' % ANALYSIS_SCALABLE,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Chunk size (particles)",
+                      help="Number of particles processed at once.")
+        form.addParam('useCache', params.BooleanParam, default=True,
+                      condition='analysisBackend==%d or (doGraphTraversal '
+                                'and traversalBackend==%d) or (doLandscape '
+                                'and landscapeBackend==%d)' % ((ANALYSIS_SCALABLE,) * 3),
+                      label="Reuse cached analysis results?",
+                      help="PCA, k-means, UMAP and nearest neighbor graph "
+                           "results are stored next to the training outputs, "
+                           "keyed by the z file and the parameters used. "
+                           "Other analyze runs of the same training epoch "
+                           "reuse them instead of computing them again, e.g. "
+                           "when only the number of k-means samples or PCs "
+                           "changes.")
 
         form.addSection(label='Landscape analysis')
         form.addParam('doLandscape', params.BooleanParam, default=False,
@@ -140,6 +272,20 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                            "the user to focus their analysis on specific regions "
                            "of interest by providing custom masks.")
 
+        form.addParam('landscapeBackend', params.EnumParam,
+                      choices=['cryodrgn', 'streaming'],
+                      default=ANALYSIS_CRYODRGN,
+                      condition='doLandscape',
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Landscape analysis with",
+                      help="*cryodrgn*: run *cryodrgn analyze_landscape*, "
+                           "which keeps all volumes in memory.\n"
+                           "*streaming*: for many or large volumes. Volumes "
+                           "are generated in parallel on the available "
+                           "devices, their masked voxels are written into "
+                           "one memory-mapped matrix and volume PCA is "
+                           "computed incrementally, so memory does not "
+                           "grow with the number of volumes.")
         form.addParam('numVols', params.IntParam, default=500,
                       condition='doLandscape',
                       label="Number of volumes to generate")
@@ -168,7 +314,30 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                        display=params.EnumParam.DISPLAY_HLIST,
                        label="Linkage for agglomerative clustering")
         group.addParam('numClusters', params.IntParam, default=10,
-                       label="Number of clusters")
+                       label="Number of clusters",
+                       help="Clustering used to define the output states.")
+        group.addParam('sweepClusters', params.NumericRangeParam, default='',
+                       allowsNull=True,
+                       label="Other numbers of clusters to try",
+                       help="E.g. *5-8* or *4 6 12*. Each setting is "
+                            "clustered from the same generated volumes and "
+                            "volume PCA, so it is much cheaper than a new "
+                            "landscape run. Plots for every setting can be "
+                            "compared in the viewer.")
+        group.addParam('sweepLinkages', params.BooleanParam, default=False,
+                       label="Try both linkages?",
+                       help="Also cluster with the other linkage for "
+                            "every number of clusters.")
+
+        group = form.addGroup('States', condition='doLandscape')
+        group.addParam('doBackproject', params.BooleanParam, default=False,
+                       label="Reconstruct each state?",
+                       help="Run *cryodrgn backproject_voxel* on the particles "
+                            "assigned to each landscape state. Reconstructions "
+                            "run concurrently, one per GPU (or one per "
+                            "thread if no GPUs are used).")
+
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
@@ -182,21 +351,217 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
 
         self._createFilenameTemplates()
 
-        self._insertFunctionStep(self.runAnalysisStep, self._epoch)
-        self._insertFunctionStep(self.createOutputStep)
+        if not self.hasMultLatentVars():
+            deps = [self._insertFunctionStep(self.runAnalysisStep, self._epoch)]
+        else:
+            analyzeId = self._insertFunctionStep(self.runAnalysisStep,
+                                                 self._epoch, needsGPU=False)
+            deps = [self._insertFunctionStep(self.createDensityTilesStep,
+                                             prerequisites=[analyzeId],
+                                             needsGPU=False)]
+            # volume steps use all GPUs, so they run one after the other
+            groups = self._getVolumeGroups()
+            adaptive = self.trajectorySampling == TRAJECTORY_ADAPTIVE
+            volsId = self._insertFunctionStep(self.generateVolumesStep,
+                                              groups[:1] if adaptive else groups,
+                                              prerequisites=[analyzeId],
+                                              needsGPU=False)
+            if adaptive:
+                volsId = self._insertFunctionStep(self.generateTrajectoriesStep,
+                                                  groups[1:],
+                                                  prerequisites=[volsId],
+                                                  needsGPU=False)
+            deps.append(volsId)
+
+            if self.doGraphTraversal:
+                graphId = self._insertFunctionStep(self.runGraphTraversalStep,
+                                                   self._epoch,
+                                                   prerequisites=[analyzeId],
+                                                   needsGPU=False)
+                volsId = self._insertFunctionStep(
+                    self.generateTrajectoriesStep if adaptive else self.generateVolumesStep,
+                    [(self._getFileName('graph_pathZ'),
+                      self._getFileName('graph_vols'))],
+                    prerequisites=[graphId, volsId], needsGPU=False)
+                deps.append(volsId)
+
+            volDirs = [volDir for _, volDir in groups]
+            if self.doGraphTraversal:
+                volDirs.append(self._getFileName('graph_vols'))
+            if self.doThumbnails:
+                deps.append(self._insertFunctionStep(self.createThumbnailsStep,
+                                                     volDirs,
+                                                     prerequisites=[volsId],
+                                                     needsGPU=False))
+            if self.doProxies:
+                deps.append(self._insertFunctionStep(self.createProxiesStep,
+                                                     volDirs,
+                                                     prerequisites=[volsId],
+                                                     needsGPU=False))
+
+            if self.doLandscape and self.landscapeBackend == ANALYSIS_SCALABLE:
+                sketchId = self._insertFunctionStep(self.runLandscapeSketchStep,
+                                                    self._epoch,
+                                                    prerequisites=[analyzeId],
+                                                    needsGPU=False)
+                volsId = self._insertFunctionStep(
+                    self.generateVolumesStep,
+                    [(self._getFileName('landscape_kmeans_z', numVols=self.numVols.get()),
+                      self._getFileName('landscape_kmeans_dir', numVols=self.numVols.get()))],
+                    True,  # landscape volumes
+                    prerequisites=[sketchId, volsId], needsGPU=False)
+                landscapeId = self._insertFunctionStep(self.runLandscapeAnalysisStep,
+                                                       prerequisites=[volsId],
+                                                       needsGPU=False)
+                deps.append(landscapeId)
+                if self.doThumbnails:
+                    deps.append(self._insertFunctionStep(
+                        self.createThumbnailsStep,
+                        [self._getFileName('landscape_kmeans_dir', numVols=self.numVols.get())],
+                        prerequisites=[landscapeId], needsGPU=False))
+            elif self.doLandscape:
+                deps.append(self._insertFunctionStep(self.runLandscapeStep,
+                                                     self._epoch,
+                                                     prerequisites=[analyzeId, volsId]))
+
+        self._insertFunctionStep(self.createOutputStep, prerequisites=deps,
+                                 needsGPU=False)
+
+        if self.hasMultLatentVars():
+            self._insertFunctionStep(self.createParticlesStep, needsGPU=False)
+
+        if self.doLandscape and self.hasMultLatentVars():
+            self._insertFunctionStep(self.createStatesStep, needsGPU=False)
+            if self.doBackproject:
+                self._insertFunctionStep(self.runBackprojectStep, needsGPU=False)
+                self._insertFunctionStep(self.createStateVolumesStep,
+                                         needsGPU=False)
+
+        # after all other steps, so that every artifact is listed
+        self._insertFunctionStep(self.writeManifestStep, needsGPU=False)
 
     # --------------------------- STEPS functions -----------------------------
     def runAnalysisStep(self, epoch):
+        """ Run PCA, k-means and UMAP. For zDim > 1 volumes are
+        generated by separate steps, so this runs on CPU only. """
         pwutils.makePath(self.getOutputDir())
-        self._runProgram('analyze', self._getAnalyzeArgs(epoch))
-
-        if self.doGraphTraversal and self.hasMultLatentVars():
-            self._runProgram('graph_traversal', self._getGraphArgs())
-            self._runProgram('eval_vol', self._getEvalArgs())
+        if not self.hasMultLatentVars():
+            self._runProgram('analyze', self._getAnalyzeArgs(epoch))
+            return
 
-        if self.doLandscape and self.hasMultLatentVars():
-            self.convertInputs(epoch)
-            self._runProgram('analyze_landscape', self._getLandscapeArgs(epoch))
+        if self.analysisBackend == ANALYSIS_SCALABLE:
+            self._runScript('analyze_latent.py',
+                            self._getScalableAnalysisArgs(epoch), gpus='')
+        else:
+            # write PC traversal z values and create the pcN folders
+            self._runScript('pc_traversal.py', self._getPcTraversalArgs(epoch),
+                            gpus='')
+            self._runProgram('analyze', self._getAnalyzeArgs(epoch), gpus='')
+
+        pwutils.copyFile(self._getFileName('kmeans_z', ksamples=self.ksamples.get()),
+                         self._getFileName('z_valuesN', ksamples=self.ksamples.get()))
+
+    def generateVolumesStep(self, groups, landscape=False):
+        """ Generate volumes for each (z values file, output folder)
+        group, in batches decoded concurrently on all devices. Landscape
+        volumes are not inverted, as analyze_landscape, and are stacked
+        only after the landscape analysis has read them. """
+        inputProt = self._getInputProt()
+        zValues = [np.loadtxt(zFile, ndmin=2) for zFile, _ in groups]
+        self._generateVolumesOnDevices(
+            [(z, volDir) for z, (_, volDir) in zip(zValues, groups)],
+            inputProt._getFileName('weights', epoch=self._epoch),
+            inputProt._getFileName('config'),
+            apix=self._getSamplingRate(), flip=self.doFlip.get(),
+            downsample=self.boxSize.get() if self.doDownsample else None,
+            invert=self.doInvert.get() and not landscape)
+
+        if self.doStack and not landscape:
+            for z, (_, volDir) in zip(zValues, groups):
+                stackVolumes(volDir, len(z))
+
+    def generateTrajectoriesStep(self, groups):
+        """ Adaptively sample volumes along each (path z values file,
+        output folder) trajectory, trajectories run concurrently. """
+        inputProt = self._getInputProt()
+        weights = inputProt._getFileName('weights', epoch=self._epoch)
+        config = inputProt._getFileName('config')
+        kwargs = dict(budget=self.trajectoryBudget.get(),
+                      tolerance=self.trajectoryTolerance.get(),
+                      apix=self._getSamplingRate(), flip=self.doFlip.get(),
+                      downsample=self.boxSize.get() if self.doDownsample else None,
+                      invert=self.doInvert.get())
+
+        def _generate(group, gpus):
+            zFile, volDir = group
+            return len(generateAdaptiveTrajectory(np.loadtxt(zFile, ndmin=2),
+                                                  weights, config, volDir,
+                                                  gpus=gpus, **kwargs))
+
+        counts = self._runOnDevices(_generate, groups)
+
+        if self.doStack:
+            for (_, volDir), count in zip(groups, counts):
+                stackVolumes(volDir, count)
+
+    def createDensityTilesStep(self):
+        """ Save PCA and UMAP coordinates of all particles and their
+        multi-resolution density histograms for the viewer explorer. """
+        pwutils.makePath(self._getExtraPath('explorer'))
+        spaces = {'pca': np.load(self._getFileName('pc_projections'))[:, :2]}
+        if os.path.exists(self._getFileName('umaps')):  # only for zDim > 2
+            spaces['umap'] = np.asarray(self._loadPkl(self._getFileName('umaps')))
+
+        for space, coords in spaces.items():
+            coords = np.ascontiguousarray(coords, dtype=np.float32)
+            np.save(self._getFileName('explorer_coords', space=space), coords)
+            makeDensityTiles(coords, self._getFileName('explorer_tiles',
+                                                       space=space))
+
+    def createThumbnailsStep(self, volDirs):
+        """ Render PNG mosaics of the volumes of each folder. """
+        for volDir in volDirs:
+            makeThumbnails(volDir, threads=self.numberOfThreads.get())
+
+    def createProxiesStep(self, volDirs):
+        """ Write low resolution proxies of the volumes of each folder. """
+        for volDir in volDirs:
+            makeProxies(volDir, self.proxyBoxSize.get(),
+                        threads=self.numberOfThreads.get())
+
+    def runGraphTraversalStep(self, epoch):
+        if self.traversalBackend == ANALYSIS_SCALABLE:
+            self._runScript('latent_traversal.py',
+                            self._getScalableGraphArgs(epoch), gpus='')
+        else:
+            self._runProgram('graph_traversal', self._getGraphArgs(epoch),
+                             gpus='')
+
+    def runLandscapeStep(self, epoch):
+        """ Generate volumes with the first clustering setting,
+        the remaining ones reuse them. """
+        self.convertInputs(epoch)
+        for i, (linkage, clusters) in enumerate(self._getClusteringGrid()):
+            self._runProgram('analyze_landscape',
+                             self._getLandscapeArgs(epoch, linkage, clusters,
+                                                    skipVol=i > 0),
+                             gpus=self._getStepGpus())
+
+        if self.doStack:
+            self._stackLandscapeVolumes()
+
+    def runLandscapeSketchStep(self, epoch):
+        """ Choose the z values of the landscape volumes by k-means. """
+        self.convertInputs(epoch)
+        self._runScript('landscape.py', self._getLandscapeSketchArgs(epoch),
+                        gpus='')
+
+    def runLandscapeAnalysisStep(self):
+        self._runScript('landscape.py', self._getLandscapeAnalysisArgs(),
+                        gpus='')
+
+        if self.doStack:
+            self._stackLandscapeVolumes()
 
     def createOutputStep(self):
         """ Create a set of k-means sample volumes with z_values. """
@@ -209,10 +574,93 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
         self._defineSourceRelation(self._getInputProt()._getInputParticles(pointer=True),
                                    setOfVolumes)
 
+    def createParticlesStep(self):
+        """ Create a set of particles annotated with k-means labels, UMAP
+        and PCA coordinates, and a set of classes from k-means labels. """
+        inputSet = self._getInputProt().Particles
+        outSet = self._createSetOfParticlesFlex(progName=CRYODRGN)
+        outSet.copyInfo(inputSet)
+        outSet.setHasCTF(inputSet.hasCTF())
+        outSet.copyItems(inputSet,
+                         updateItemCallback=self._setAnalysisValues,
+                         itemDataIterator=self._iterParticlesAnalysis())
+
+        self._defineOutputs(**{outputs.Particles.name: outSet})
+        self._defineSourceRelation(inputSet, outSet)
+
+        self._kmeansVols = [vol.clone() for vol in self.Volumes]
+        classes = self._createSetOfClasses3D(outSet)
+        classes.classifyItems(updateItemCallback=self._setClassId,
+                              updateClassCallback=self._setRepresentative)
+
+        self._defineOutputs(**{outputs.Classes.name: classes})
+        self._defineSourceRelation(outSet, classes)
+        self._defineSourceRelation(self.Volumes, classes)
+
+    def createStatesStep(self):
+        """ Create a particle subset for each landscape state
+        in a single pass over the input particles. """
+        pwutils.makePath(self._getExtraPath('states'))
+        inputSet = self._getInputProt().Particles
+        states = self._getParticleStates()
+        outSets, indices = dict(), dict()
+
+        for index, (particle, state) in enumerate(zip(inputSet, states)):
+            if state not in outSets:
+                outSet = self._createSetOfParticlesFlex(
+                    suffix=f"_state{state+1:02d}", progName=CRYODRGN)
+                outSet.copyInfo(inputSet)
+                outSet.setHasCTF(inputSet.hasCTF())
+                outSets[state], indices[state] = outSet, []
+            outSets[state].append(particle)
+            indices[state].append(index)
+
+        for state in sorted(outSets):
+            with open(self._getFileName('state_ind', state=state+1), "wb") as f:
+                pickle.dump(indices[state], f)
+            self._defineOutputs(**{f"Particles_state{state+1:02d}": outSets[state]})
+            self._defineSourceRelation(self._getInputProt().Particles, outSets[state])
+
+    def runBackprojectStep(self):
+        """ Reconstruct every state concurrently on the available devices. """
+        states = self._getStates()
+
+        def _backproject(state, gpus):
+            pwutils.makePath(self._getFileName('state_dir', state=state))
+            self._runProgram('backproject_voxel',
+                             self._getBackprojectArgs(state), gpus=gpus)
+
+        self._runOnDevices(_backproject, states)
+
+    def createStateVolumesStep(self):
+        """ Create a set of volumes reconstructed from each state. """
+        volSet = self._createSetOfVolumes(suffix='States')
+        volSet.setSamplingRate(self._getSamplingRate())
+        volSet.setObjComment("landscape state reconstructions")
+
+        for state in self._getStates():
+            vol = Volume()
+            vol.setFileName(self._getFileName('state_vol', state=state))
+            vol.setObjLabel(f"state {state}")
+            volSet.append(vol)
+
+        self._defineOutputs(StateVolumes=volSet)
+        self._defineSourceRelation(self._getInputProt().Particles, volSet)
+
+    def writeManifestStep(self):
+        self._writeManifest()
+
     # --------------------------- INFO functions ------------------------------
     def _summary(self):
         summary = []
 
+        if self.isFinished():
+            states = [name for name, _ in self.iterOutputAttributes()
+                      if name.startswith("Particles_state")]
+            if states:
+                summary.append(f"Particles split into {len(states)} "
+                               "landscape states.")
+
         return summary
 
     def _warnings(self):
@@ -251,6 +699,15 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
             if newBox > origBox:
                 errors.append("You cannot upscale volumes!")
 
+        if self.doProxies:
+            volBox = self.boxSize.get() if self.doDownsample else self._getBoxSize()
+            if self.proxyBoxSize > volBox:
+                errors.append("Proxy box size cannot be larger than the volumes!")
+
+        if (self.trajectorySampling == TRAJECTORY_ADAPTIVE
+                and self.trajectoryBudget < 2):
+            errors.append("At least 2 volumes per trajectory are needed!")
+
         if self.doLandscape:
             if self.inputMask.hasValue():
                 maskSize = self.inputMask.get().getXDim()
@@ -262,14 +719,132 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
             if not self.autoMask and not self.inputMask.hasValue():
                 errors.append("Please provide an input mask or choose auto-masking!")
 
+            if any(m < 2 or m > self.numVols for _, m in self._getClusteringGrid()):
+                errors.append("Numbers of clusters must be between 2 and "
+                              "the number of volumes!")
+
         return errors
 
     # --------------------------- UTILS functions -----------------------------
+    def hasManifest(self):
+        """ Return False for runs from older versions without manifest. """
+        return self._loadManifest() is not None
+
+    def getArtifact(self, kind, **kwargs):
+        """ Return the manifest entry of the given kind and parameters,
+        or None if there is none. """
+        return next(iter(self.getArtifacts(kind, **kwargs)), None)
+
+    def getArtifacts(self, kind, **kwargs):
+        """ Return all manifest entries of the given kind and parameters,
+        in the order they were written. """
+        return [artifact for artifact in self._loadManifest() or []
+                if artifact['kind'] == kind and all(
+                    artifact['params'].get(k) == v for k, v in kwargs.items())]
+
+    def getArtifactPath(self, kind, **kwargs):
+        """ Return the path of an artifact listed in the manifest with
+        the given kind and parameters, or None if there is none. """
+        artifact = self.getArtifact(kind, **kwargs)
+        return None if artifact is None else artifact['path']
+
+    def _loadManifest(self):
+        if not hasattr(self, '_manifest'):
+            try:
+                with open(self._getExtraPath("manifest.json")) as f:
+                    self._manifest = json.load(f)['artifacts']
+            except FileNotFoundError:  # runs from older versions
+                self._manifest = None
+
+        return self._manifest
+
+    def _writeManifest(self):
+        """ List every folder and file produced, with epoch, kind and
+        parameters, so that they can be found without directory scans. """
+        artifacts = []
+
+        def _add(kind, path, artifactParams=None, **extra):
+            if os.path.exists(path):
+                artifacts.append(dict(kind=kind, epoch=self._epoch,
+                                      path=os.path.normpath(path),
+                                      params=artifactParams or {}, **extra))
+
+        _add('analyze_dir', self._getFileName('analyze_dir'))
+        _add('notebook', self._getFileName('notebook'))
+
+        for groupParams, volDir in self._getVolumeArtifactGroups():
+            locations = getVolumeLocations(volDir)
+            stacked = bool(locations) and isinstance(locations[0], tuple)
+            _add('volumes', volDir, groupParams, count=len(locations),
+                 stack=getVolumeStackName(volDir) if stacked else None)
+            page = 0
+            while os.path.exists(getThumbnailName(volDir, page)):
+                _add('thumbnail', getThumbnailName(volDir, page),
+                     dict(groupParams, page=page))
+                page += 1
+            _add('proxy_dir', os.path.dirname(getProxyName(volDir, 0)), groupParams)
+
+        if self.hasMultLatentVars():
+            ksamples = self.ksamples.get()
+            _add('kmeans_dir', self._getFileName('kmeans_dir', ksamples=ksamples),
+                 {'ksamples': ksamples})
+            for pc in range(1, self.pc.get() + 1):
+                _add('pc_dir', self._getFileName('pc_dir', pc=pc), {'pc': pc})
+            for space in ['pca', 'umap']:
+                _add('explorer_coords', self._getFileName('explorer_coords', space=space),
+                     {'space': space})
+                _add('explorer_tiles', self._getFileName('explorer_tiles', space=space),
+                     {'space': space})
+
+            if self.doGraphTraversal:
+                _add('graph_dir', self._getFileName('graph_vols'))
+
+            if self.doLandscape:
+                numVols = self.numVols.get()
+                _add('landscape_dir', self._getFileName('landscape_dir'),
+                     {'numVols': numVols})
+                for linkage, clusters in self._getClusteringGrid():
+                    _add('landscape_clustering',
+                         os.path.dirname(self._getFileName('landscape_state_labels',
+                                                           linkage=linkage,
+                                                           clusters=clusters)),
+                         {'linkage': linkage, 'clusters': clusters})
+
+                for state in self._getStates():
+                    _add('state_ind', self._getFileName('state_ind', state=state),
+                         {'state': state})
+                    _add('state_vol', self._getFileName('state_vol', state=state),
+                         {'state': state})
+
+        manifest = {'epoch': self._epoch, 'artifacts': artifacts}
+        with open(self._getFileName('manifest'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        self._manifest = artifacts
+
+    def _getVolumeArtifactGroups(self):
+        """ Return (manifest parameters, folder) of each set of volumes. """
+        if not self.hasMultLatentVars():
+            return [({'group': 'kmeans'}, self._getFileName('analyze_dir'))]
+
+        groups = [({'group': 'kmeans'},
+                   self._getFileName('kmeans_dir', ksamples=self.ksamples.get()))]
+        groups.extend(({'group': 'pc', 'pc': pc}, self._getFileName('pc_dir', pc=pc))
+                      for pc in range(1, self.pc.get() + 1))
+        if self.doGraphTraversal:
+            groups.append(({'group': 'graph'}, self._getFileName('graph_vols')))
+        if self.doLandscape:
+            groups.append(({'group': 'landscape'},
+                           self._getFileName('landscape_kmeans_dir',
+                                             numVols=self.numVols.get())))
+
+        return groups
+
     def convertInputs(self, epoch):
         # Copy analyze.epoch/umap.pkl to landscape.epoch folder
         pwutils.makePath(self.getOutputDir(f'landscape.{epoch}'))
-        pwutils.copyFile(self._getFileName('umaps'),
-                         self.getOutputDir(f'landscape.{epoch}/umap.pkl'))
+        if os.path.exists(self._getFileName('umaps')):  # only for zDim > 2
+            pwutils.copyFile(self._getFileName('umaps'),
+                             self.getOutputDir(f'landscape.{epoch}/umap.pkl'))
 
         if not self.autoMask:
             # convert mask to mrc
@@ -286,19 +861,67 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
             f"{epoch}",
             f"-o {self.getOutputDir(f'analyze.{epoch}')}",
             f"--Apix {self._getSamplingRate()}",
-            f"--device {self.gpuList.get()}",
             f"-d {self.boxSize}" if self.doDownsample else "",
             "--flip" if self.doFlip else "",
-            "--invert" if self.doInvert else "",
-            f"--ksample {self.ksamples}" if self.hasMultLatentVars() else "",
-            f"--pc {self.pc}" if self.hasMultLatentVars() else ""
+            "--invert" if self.doInvert else ""
+        ]
+
+        if self.hasMultLatentVars():
+            args.extend([
+                f"--ksample {self.ksamples}",
+                f"--pc {self.pc}",
+                "--skip-vol"
+            ])
+        else:
+            args.append(f"--device {self.gpuList.get()}")
+
+        return args
+
+    def _getPcTraversalArgs(self, epoch):
+        args = [
+            self._getInputProt()._getFileName('z', epoch=epoch),
+            f"-o {self.getOutputDir(f'analyze.{epoch}')}",
+            f"--pc {self.pc}"
+        ]
+
+        return args
+
+    def _getScalableAnalysisArgs(self, epoch):
+        args = [
+            self._getInputProt()._getFileName('z', epoch=epoch),
+            f"-o {self.getOutputDir(f'analyze.{epoch}')}",
+            f"--epoch {epoch}",
+            f"--ksample {self.ksamples}",
+            f"--pc {self.pc}",
+            f"--umap-sample {self.umapSample}",
+            f"--chunk-size {self.chunkSize}",
+            f"--threads {self.numberOfThreads}"
         ]
 
+        if self.useCache:
+            args.append(f"--cache-dir {self._getCacheDir()}")
+
         return args
 
-    def _getGraphArgs(self):
+    def _getCacheDir(self):
+        """ Analysis cache shared by all analyze runs of the input run. """
+        return os.path.abspath(self._getInputProt()._getExtraPath('analysis_cache'))
+
+    def _getVolumeGroups(self):
+        """ Return (z values file, output folder) for each set of
+        volumes to generate: k-means samples and PC traversals. """
+        ksamples = self.ksamples.get()
+        groups = [(self._getFileName('z_valuesN', ksamples=ksamples),
+                   self._getFileName('kmeans_dir', ksamples=ksamples))]
+        groups.extend((self._getFileName('pc_z', pc=pc),
+                       self._getFileName('pc_dir', pc=pc))
+                      for pc in range(1, self.pc.get() + 1))
+
+        return groups
+
+    def _getGraphArgs(self, epoch):
         args = [
-            self._getInputProt()._getFileName('z_final'),
+            self._getInputProt()._getFileName('z', epoch=epoch),
             f"--anchors $(cat {self._getFileName('kmeans_centers', ksamples=self.ksamples)})"
         ]
 
@@ -315,30 +938,70 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
 
         return args
 
-    def _getEvalArgs(self):
+    def _getScalableGraphArgs(self, epoch):
         args = [
-            self._getInputProt()._getFileName('weights_final'),
-            f"-c {self._getInputProt()._getFileName('config')}",
-            f"--zfile {self._getFileName('graph_pathZ')}",
-            f"-o {self._getFileName('graph_vols')}"
+            self._getInputProt()._getFileName('z', epoch=epoch),
+            f"--anchors {self._getFileName('kmeans_centers', ksamples=self.ksamples)}",
+            f"--outind {self._getFileName('graph_path')}",
+            f"--outtxt {self._getFileName('graph_pathZ')}",
+            f"--threads {self.numberOfThreads}"
         ]
 
+        if self.useCache:
+            args.append(f"--cache-dir {self._getCacheDir()}")
+
         return args
 
-    def _getLandscapeArgs(self, epoch):
+    def _getLandscapeArgs(self, epoch, linkage, clusters, skipVol=False):
         args = [
             self._getInputProt()._getExtraPath("output"),
             f"{epoch}",
             f"-o {self.getOutputDir(f'landscape.{epoch}')}",
             f"--Apix {self._getSamplingRate()}",
-            f"--device {self.gpuList.get()}",
+            "--device 0",
             "--skip-umap",
             f"-N {self.numVols}",
-            f"--linkage {self.getEnumText('linkage')}",
-            f"-M {self.numClusters}",
+            f"--linkage {linkage}",
+            f"-M {clusters}",
             f"-d {self.boxSize if self.doDownsample else self._getBoxSize()}",
             "--flip" if self.doFlip else "",
-            f"--pc-dim {min(self.numVols, 20)}"
+            f"--pc-dim {self._getLandscapePcDim()}",
+            "--skip-vol" if skipVol else ""
+        ]
+
+        if self.autoMask:
+            args.append(f"--dilate {self.dilate}")
+
+            if not self.threshold < 0.001:  # consider as 0
+                args.append(f"--thresh {self.threshold}")
+
+        else:
+            args.append(f"--mask {self._getFileName('input_mask')}")
+
+        return args
+
+    def _getLandscapeSketchArgs(self, epoch):
+        args = [
+            "sketch",
+            self._getInputProt()._getFileName('z', epoch=epoch),
+            f"-o {self._getFileName('landscape_dir')}",
+            f"-N {self.numVols}"
+        ]
+
+        if self.useCache:
+            args.append(f"--cache-dir {self._getCacheDir()}")
+
+        return args
+
+    def _getLandscapeAnalysisArgs(self):
+        args = [
+            "analyze",
+            f"-o {self._getFileName('landscape_dir')}",
+            f"-N {self.numVols}",
+            f"--clustering {' '.join(f'{l}:{m}' for l, m in self._getClusteringGrid())}",
+            f"--pc-dim {self._getLandscapePcDim()}",
+            f"--chunk-size {max(2 * self._getLandscapePcDim(), 50)}",
+            f"--Apix {self._getOutputSampling()}"
         ]
 
         if self.autoMask:
@@ -352,8 +1015,114 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
 
         return args
 
+    def _stackLandscapeVolumes(self):
+        numVols = self.numVols.get()
+        stackVolumes(self._getFileName('landscape_kmeans_dir', numVols=numVols),
+                     numVols)
+
+    def _getLandscapePcDim(self):
+        return min(self.numVols.get(), 20)
+
+    def _getClusteringGrid(self):
+        """ Return (linkage, number of clusters) settings to evaluate,
+        starting with the one used to define the output states. """
+        linkage = self.getEnumText('linkage')
+        linkages = [linkage]
+        if self.sweepLinkages:
+            linkages.extend(l for l in ['average', 'ward'] if l != linkage)
+
+        clusters = [self.numClusters.get()]
+        if self.sweepClusters.hasValue():
+            clusters.extend(m for m in pwutils.getListFromRangeString(
+                self.sweepClusters.get()) if m not in clusters)
+
+        return [(l, m) for l in linkages for m in clusters]
+
+    def _getBackprojectArgs(self, state):
+        inputProt = self._getInputProt()
+        run = inputProt._getRun()
+        if inputProt.getClassName() == "CryoDrgnProtAbinitio":
+            poses = inputProt._getFileName('poses', epoch=self._epoch)
+        else:
+            poses = inputProt._getFileName('input_poses')
+
+        if Plugin.versionGE(V3_4_0):
+            outFn = self._getFileName('state_dir', state=state)
+        else:
+            outFn = self._getFileName('state_vol', state=state)
+
+        args = [
+            inputProt._getFileName('input_parts'),
+            f"--poses {poses}",
+            f"--ctf {inputProt._getFileName('input_ctfs')}",
+            f"--ind {self._getFileName('state_ind', state=state)}",
+            f"--datadir {inputProt._getExtraPath('input')}",
+            f"-o {outFn}"
+        ]
+
+        if not run.doInvert:
+            args.append('--uninvert-data')
+
+        if run.lazyLoad:
+            args.append('--lazy')
+
+        return args
+
+    def _iterParticlesAnalysis(self):
+        """ Yield (k-means label, UMAP coordinates, PCA coordinates)
+        for each particle. PCA coordinates come from the same PCA as
+        the PC traversals, so they share axes and signs. """
+        labels = self._loadPkl(self._getFileName('kmeans_labels',
+                                                 ksamples=self.ksamples.get()))
+        pcs = np.load(self._getFileName('pc_projections'))[:, :self.pc.get()]
+
+        umapFn = self._getFileName('umaps')
+        if os.path.exists(umapFn):  # only for zDim > 2
+            umaps = self._loadPkl(umapFn)
+        else:
+            umaps = [None] * len(labels)
+
+        return zip(labels, umaps, pcs)
+
+    def _setAnalysisValues(self, item, row):
+        label, umap, pcs = row
+        setattr(item, KMEANS_LABEL, pwobj.Integer(int(label)))
+        if umap is not None:
+            for i, value in enumerate(umap, start=1):
+                setattr(item, UMAP_COORD % i, pwobj.Float(float(value)))
+        for i, value in enumerate(pcs, start=1):
+            setattr(item, PCA_COORD % i, pwobj.Float(float(value)))
+
+    def _setClassId(self, item, row=None):
+        item.setClassId(getattr(item, KMEANS_LABEL).get() + 1)
+
+    def _setRepresentative(self, item):
+        vol = self._kmeansVols[item.getObjId() - 1]
+        item.setRepresentative(vol.clone())
+
+    def _getParticleStates(self):
+        """ Map landscape k-means labels of each particle to its state. """
+        kmeansLabels = self._loadPkl(self._getFileName(
+            'landscape_kmeans_labels', numVols=self.numVols.get()))
+        stateLabels = self._loadPkl(self._getFileName(
+            'landscape_state_labels', linkage=self.getEnumText('linkage'),
+            clusters=self.numClusters.get()))
+
+        return np.asarray(stateLabels)[np.asarray(kmeansLabels)].tolist()
+
+    def _getStates(self):
+        """ Return 1-based ids of the states with particles assigned. """
+        return [s for s in range(1, self.numClusters.get() + 1)
+                if os.path.exists(self._getFileName('state_ind', state=s))]
+
+    @staticmethod
+    def _loadPkl(fn):
+        with open(fn, 'rb') as f:
+            return pickle.load(f)
+
     def _getVolumes(self):
-        """ Returns a list of volume names and their zValues. """
+        """ Returns a list of volume locations (file names, or
+        (index, stack) if volumes were stacked) and their zValues. """
         vols = []
         if self.hasMultLatentVars():
             fn = 'output_volN'
@@ -367,6 +1136,13 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
             zValue = 'z_values'
             zValues = self._getVolumeZvalues(self._getFileName(zValue))
 
+        if self.hasMultLatentVars() and self.doStack:
+            stackFn = getVolumeStackName(self._getFileName('kmeans_dir',
+                                                           ksamples=num))
+            if not os.path.exists(stackFn):
+                raise FileNotFoundError(f"Volume stack {stackFn} does not exist.")
+            return [(i + 1, stackFn) for i in range(num)], zValues
+
         for volId in range(num):
             if self.hasMultLatentVars():
                 volFn = self._getFileName(fn, ksamples=num, epoch=self._epoch,
@@ -394,7 +1170,7 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
                          updateItemCallback=None):
         """
         Create a set of volume with the associated z_values
-        :param files: list of the volumes path
+        :param files: list of the volumes path or (index, stack) locations
         :param zValues: list with the volumes z_values
         :param path: output path
         :param samplingRate: volumes sampling rate
@@ -411,7 +1187,7 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
 
         for volFn in files:
             vol = Volume()
-            vol.setFileName(volFn)
+            vol.setLocation(volFn)
             vector = pwobj.CsvList()
             # We assume that each row "i" of z_values corresponds to each
             # volumes with ID "i"
@@ -441,11 +1217,7 @@ class CryoDrgnProtAnalyze(ProtAnalysis3D, CryoDrgnProtBase):
             return self._getSamplingRate()
 
     def hasMultLatentVars(self):
-        inputProt = self._getInputProt()
-        if inputProt.doContinue:
-            return inputProt.continueRun.get().zDim.get() > 1
-        else:
-            return inputProt.zDim.get() > 1
+        return self._getInputProt().getZDim() > 1
 
     def _getLastEpoch(self):
         return self._getInputProt()._getLastEpoch()
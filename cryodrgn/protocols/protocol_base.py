@@ -26,10 +26,16 @@
 # *
 # **************************************************************************
 
+import os
 import pickle
 import re
+import queue
+import shutil
 from glob import glob
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 import pyworkflow.protocol.params as params
 import pyworkflow.utils as pwutils
@@ -40,6 +46,7 @@ from pwem.objects import SetOfParticlesFlex, ParticleFlex
 
 from cryodrgn import Plugin
 from cryodrgn.constants import WEIGHTS, CONFIG, CRYODRGN
+from cryodrgn.utils import generateVolumes, getVolumeName
 
 
 convert = Domain.importFromPlugin('relion.convert', doRaise=True)
@@ -63,6 +70,8 @@ class CryoDrgnProtBase(ProtProcessParticles, ProtFlexBase):
             'z_final': self.getOutputDir('z.pkl'),
             'weights': self.getOutputDir('weights.%(epoch)d.pkl'),
             'weights_final': self.getOutputDir('weights.pkl'),
+            'poses': self.getOutputDir('pose.%(epoch)d.pkl'),
+            'latent_index': self._getExtraPath('latent_index', 'z.%(epoch)d.kdtree.pkl'),
             'config': self.getOutputDir('config.yaml')
         }
         self._updateFilenamesDict(myDict)
@@ -238,10 +247,71 @@ class CryoDrgnProtBase(ProtProcessParticles, ProtFlexBase):
 
         return args
 
-    def _runProgram(self, program, args):
-        gpus = ','.join(str(i) for i in self.getGpuList())
+    def _runProgram(self, program, args, gpus=None):
+        if gpus is None:
+            gpus = ','.join(str(i) for i in self.getGpuList())
         self.runJob(Plugin.getProgram(program, gpus), ' '.join(args))
 
+    def _runScript(self, script, args, gpus=None):
+        if gpus is None:
+            gpus = ','.join(str(i) for i in self.getGpuList())
+        self.runJob(Plugin.getPythonProgram(script, gpus), ' '.join(args),
+                    env=Plugin.getEnviron())
+
+    def _getStepGpus(self):
+        """ Return the GPUs assigned by the executor to the running step. """
+        gpus = self._stepsExecutor.getGpuList() or self.getGpuList()
+        return ','.join(str(i) for i in gpus)
+
+    def _getWorkerDevices(self):
+        """ Return CUDA_VISIBLE_DEVICES values, one per concurrent worker.
+        Without GPUs, use one CPU worker per thread. """
+        gpus = [str(i) for i in self.getGpuList()]
+        if gpus:
+            return gpus
+
+        return [''] * max(self.numberOfThreads.get(), 1)
+
+    def _runOnDevices(self, func, items):
+        """ Call func(item, gpus) for every item, running
+        concurrently one worker per available device. """
+        devices = queue.Queue()
+        for device in self._getWorkerDevices():
+            devices.put(device)
+
+        def _worker(item):
+            device = devices.get()
+            try:
+                return func(item, device)
+            finally:
+                devices.put(device)
+
+        with ThreadPoolExecutor(max_workers=devices.qsize()) as executor:
+            return list(executor.map(_worker, items))
+
+    def _generateVolumesOnDevices(self, groups, weights, config, **kwargs):
+        """ Generate outdir/vol_NNN.mrc for each row of zValues of every
+        (zValues, outdir) group. Each group is split in one batch per
+        available device and batches run concurrently. """
+        numDevices = len(self._getWorkerDevices())
+        batches = []
+        for zValues, outdir in groups:
+            z = np.asarray(zValues)
+            pwutils.makePath(outdir)
+            batches.extend((z[ind], outdir, ind) for ind in
+                           np.array_split(np.arange(len(z)), numDevices)
+                           if len(ind))
+
+        def _generate(batch, gpus):
+            z, outdir, ind = batch
+            batchDir = os.path.join(outdir, f'batch{ind[0]:06d}')
+            generateVolumes(z, weights, config, batchDir, gpus=gpus, **kwargs)
+            for j, i in enumerate(ind):
+                os.replace(getVolumeName(batchDir, j), getVolumeName(outdir, i))
+            shutil.rmtree(batchDir, ignore_errors=True)
+
+        self._runOnDevices(_generate, batches)
+
     def _getParticlesZvalues(self):
         """
         Read from z.pkl file the particles z_values
@@ -262,16 +332,19 @@ class CryoDrgnProtBase(ProtProcessParticles, ProtFlexBase):
 
     def _getLastEpoch(self):
         """ Return the last iteration number. """
-        epoch = None
-        epochRegex = re.compile(r'weights.(\d).pkl')
-        files = sorted(glob(self._getFileName("weights", epoch=0).replace('0', '*')))
-        if files:
-            f = files[-1]
-            s = epochRegex.search(f)
-            if s:
-                epoch = int(s.group(1))  # group 1 is a digit iteration number
-
-        return epoch
+        epochRegex = re.compile(r'weights\.(\d+)\.pkl$')
+        files = glob(self._getFileName("weights", epoch=0).replace('0', '*'))
+        epochs = [int(s.group(1)) for s in map(epochRegex.search, files) if s]
+
+        return max(epochs) if epochs else None
+
+    def _getRun(self):
+        return self.continueRun.get() if self.doContinue else self
+
+    def getZDim(self):
+        """ Return the latent dimension, set on the continued run
+        when continuing. """
+        return self._getRun().zDim.get()
 
     def _canContinue(self):
         return self._getLastEpoch() is not None
@@ -0,0 +1,210 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import numpy as np
+
+import pyworkflow.utils as pwutils
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import NEW
+from pwem.protocols import ProtAnalysis3D
+
+from cryodrgn.protocols.protocol_base import CryoDrgnProtBase
+from cryodrgn.utils import generateVolumes
+
+
+class CryoDrgnProtConvergence(ProtAnalysis3D, CryoDrgnProtBase):
+    """ CryoDrgn protocol to compare several training epochs and
+    assess convergence in a single run. """
+
+    _label = "analyze convergence"
+    _devStatus = NEW
+    _possibleOutputs = None
+
+    def _createFilenameTemplates(self):
+        """ Centralize how files are called within the protocol. """
+        out = lambda p: self._getExtraPath(p)
+
+        myDict = {
+            'epoch_dir': out('epoch%(epoch)03d'),
+            'z_anchors': out('epoch%(epoch)03d/z_anchors.txt'),
+            'report': out('convergence.json'),
+            'plot_latent': out('latent_distance.png'),
+            'plot_neighbors': out('neighborhood_stability.png'),
+            'plot_volumes': out('volume_correlation.png')
+        }
+        self._updateFilenamesDict(myDict)
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addHidden(params.GPU_LIST, params.StringParam, default='0',
+                       label="Choose GPU IDs",
+                       help="Anchor volumes of different epochs are "
+                            "generated concurrently, one epoch per GPU.")
+        form.addParam('inputProt', params.PointerParam, important=True,
+                      pointerClass='CryoDrgnProtTrain, CryoDrgnProtAbinitio',
+                      label="Previous run to analyse")
+        form.addParam('epochs', params.NumericRangeParam, default='',
+                      label="Epochs to compare",
+                      help="Epoch numbers, e.g. *5-25* or *10 15 20*. "
+                           "Leave empty to use all epochs. The last selected "
+                           "epoch is the reference for all metrics.")
+        form.addParam('epochStride', params.IntParam, default=1,
+                      validators=[params.Positive],
+                      label="Epoch stride",
+                      help="Use every N-th of the selected epochs. "
+                           "The last epoch is always used.")
+
+        form.addSection(label='Metrics')
+        form.addParam('numAnchors', params.IntParam, default=20,
+                      label="Number of anchor particles",
+                      help="Anchors are chosen by k-means on the reference "
+                           "epoch and tracked across epochs.")
+        form.addParam('doVolumes', params.BooleanParam, default=True,
+                      label="Compare volumes at anchor points?",
+                      help="Generate volumes at the anchors for every epoch "
+                           "and compute their correlation to the reference.")
+        form.addParam('numNeighbors', params.IntParam, default=20,
+                      label="Neighbors for stability",
+                      help="Neighborhood stability is the mean Jaccard index "
+                           "of the nearest neighbors of each particle in an "
+                           "epoch and in the reference.")
+        form.addParam('sampleSize', params.IntParam, default=10000,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Particles used for neighborhood stability")
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._getInputProt()._createFilenameTemplates()
+        self._createFilenameTemplates()
+
+        self._insertFunctionStep(self.prepareStep)
+        if self.doVolumes:
+            self._insertFunctionStep(self.generateVolumesStep)
+        self._insertFunctionStep(self.computeMetricsStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def prepareStep(self):
+        """ Load z files once and choose anchors on the reference epoch. """
+        self._runScript('analyze_epochs.py', self._getScriptArgs('prepare'),
+                        gpus='')
+
+    def generateVolumesStep(self):
+        """ Generate anchor volumes of every epoch concurrently. """
+        inputProt = self._getInputProt()
+
+        def _generate(epoch, gpus):
+            generateVolumes(np.loadtxt(self._getFileName('z_anchors', epoch=epoch),
+                                       ndmin=2),
+                            inputProt._getFileName('weights', epoch=epoch),
+                            inputProt._getFileName('config'),
+                            self._getFileName('epoch_dir', epoch=epoch),
+                            apix=self._getSamplingRate(), gpus=gpus)
+
+        self._runOnDevices(_generate, self._getEpochs())
+
+    def computeMetricsStep(self):
+        self._runScript('analyze_epochs.py', self._getScriptArgs('metrics'),
+                        gpus='')
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+        self._createFilenameTemplates()
+
+        if self.isFinished() and os.path.exists(self._getFileName('report')):
+            with open(self._getFileName('report')) as f:
+                report = json.load(f)
+            summary.append(f"Compared {len(report)} epochs against epoch "
+                           f"{report[-1]['epoch']}.")
+            for m in report[:-1]:
+                line = (f"Epoch {m['epoch']}: latent distance "
+                        f"{m['latent_distance_mean']:.3f}, neighborhood "
+                        f"stability {m['neighborhood_stability']:.2f}")
+                if 'volume_cc_mean' in m:
+                    line += f", volume CC {m['volume_cc_mean']:.3f}"
+                summary.append(line)
+
+        return summary
+
+    def _validate(self):
+        errors = []
+        inputProt = self._getInputProt()
+        inputProt._createFilenameTemplates()
+        total = inputProt._getLastEpoch()
+
+        if total is None:
+            errors.append("Input run has no finished epochs!")
+        else:
+            epochs = self._getEpochs()
+            if len(epochs) < 2:
+                errors.append("Select at least two epochs to compare.")
+            if epochs and max(epochs) > total:
+                errors.append(f"You can compare only epochs 1-{total+1}")
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getScriptArgs(self, action):
+        args = [
+            action,
+            self._getInputProt().getOutputDir(),
+            f"-o {self._getExtraPath()}",
+            f"--epochs {' '.join(map(str, self._getEpochs()))}",
+            f"--anchors {self.numAnchors}",
+            f"--neighbors {self.numNeighbors}",
+            f"--sample {self.sampleSize}",
+            f"--threads {self.numberOfThreads}",
+            "--volumes" if self.doVolumes else ""
+        ]
+
+        return args
+
+    def _getEpochs(self):
+        """ Return selected 0-based epochs. The last one is always kept,
+        since it is the reference. """
+        if self.epochs.get():
+            epochs = pwutils.getListFromRangeString(self.epochs.get())
+            epochs = [e - 1 for e in epochs]
+        else:
+            epochs = list(range(self._getInputProt()._getLastEpoch() + 1))
+
+        epochs = sorted(set(epochs))
+        selected = epochs[::self.epochStride.get()]
+        if epochs and selected[-1] != epochs[-1]:
+            selected.append(epochs[-1])
+
+        return selected
+
+    def _getSamplingRate(self):
+        return self._getInputProt()._getInputParticles().getSamplingRate()
+
+    def _getInputProt(self):
+        return self.inputProt.get()
@@ -0,0 +1,243 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import pickle
+from enum import Enum
+import numpy as np
+
+import pyworkflow.protocol.params as params
+import pyworkflow.object as pwobj
+from pyworkflow.constants import NEW
+from pwem.objects import SetOfParticlesFlex
+
+from cryodrgn.constants import (CRYODRGN, EPOCH_LAST, EPOCH_SELECTION,
+                                KNN_DIST, DENSITY, Z_NORM,
+                                CUTOFF_QUANTILE, CUTOFF_VALUE)
+from cryodrgn.protocols.protocol_base import CryoDrgnProtBase
+from cryodrgn.utils import LatentIndex
+
+
+class outputs(Enum):
+    Particles = SetOfParticlesFlex
+
+
+class CryoDrgnProtFilter(CryoDrgnProtBase):
+    """ CryoDrgn protocol to filter out junk particles automatically,
+    using latent density, kNN distance and z-norm scores. """
+
+    _label = "filter particles"
+    _devStatus = NEW
+    _possibleOutputs = outputs
+    doContinue = False
+
+    def _createFilenameTemplates(self):
+        """ Centralize how files are called within the protocol. """
+        myDict = {
+            'scores': self._getExtraPath('scores.npz'),
+            'kept_ind': self._getExtraPath('kept_particles_ind.pkl'),
+            'rejected_ind': self._getExtraPath('rejected_particles_ind.pkl')
+        }
+        self._updateFilenamesDict(myDict)
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputProt', params.PointerParam, important=True,
+                      pointerClass='CryoDrgnProtTrain, CryoDrgnProtAbinitio',
+                      label="Training run")
+        form.addParam('inputEpoch', params.EnumParam,
+                      choices=['last', 'selection'], default=EPOCH_LAST,
+                      display=params.EnumParam.DISPLAY_LIST,
+                      label="Epoch")
+        form.addParam('epochNum', params.IntParam,
+                      condition='inputEpoch==%d' % EPOCH_SELECTION,
+                      label="Epoch number")
+
+        form.addSection(label='Filtering')
+        form.addParam('numNeighbors', params.IntParam, default=20,
+                      validators=[params.Positive],
+                      label="Number of neighbors",
+                      help="kNN distance is the distance to the k-th nearest "
+                           "particle in latent space, density is the inverse "
+                           "of the mean distance to the k nearest ones.")
+        form.addParam('cutoffType', params.EnumParam,
+                      choices=['quantile', 'value'], default=CUTOFF_QUANTILE,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Cutoffs are",
+                      help="*quantile*: cutoffs are quantiles (0-1) of each "
+                           "score over all particles.\n"
+                           "*value*: cutoffs are score values.")
+        form.addParam('doDensity', params.BooleanParam, default=True,
+                      label="Reject low density particles?")
+        form.addParam('minDensity', params.FloatParam, default=0.01,
+                      condition='doDensity',
+                      label="Minimum density")
+        form.addParam('doKnnDist', params.BooleanParam, default=False,
+                      label="Reject isolated particles?")
+        form.addParam('maxKnnDist', params.FloatParam, default=0.99,
+                      condition='doKnnDist',
+                      label="Maximum kNN distance")
+        form.addParam('doZNorm', params.BooleanParam, default=True,
+                      label="Reject large z-norm particles?",
+                      help="Outliers far from the origin of the latent space "
+                           "are often junk particles.")
+        form.addParam('maxZNorm', params.FloatParam, default=0.99,
+                      condition='doZNorm',
+                      label="Maximum z-norm")
+        form.addParam('chunkSize', params.IntParam, default=100000,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Chunk size (particles)",
+                      help="Number of particles scored at once.")
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        self._insertFunctionStep(self.computeScoresStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def computeScoresStep(self):
+        """ Score all particles in chunks of the z matrix. """
+        inputProt = self._getInputProt()
+        epoch = self._getEpoch()
+        zFile = inputProt._getFileName('z', epoch=epoch)
+        index = LatentIndex.load(zFile, inputProt._getFileName('latent_index',
+                                                               epoch=epoch))
+        with open(zFile, 'rb') as f:
+            z = np.asarray(pickle.load(f), dtype=np.float32)
+
+        k = self.numNeighbors.get() + 1  # the particle itself is the first one
+        knnDist = np.empty(len(z), dtype=np.float32)
+        density = np.empty(len(z), dtype=np.float32)
+        chunkSize = self.chunkSize.get()
+        for start in range(0, len(z), chunkSize):
+            dist = index.query(z[start:start + chunkSize], k)[0][:, 1:]
+            knnDist[start:start + chunkSize] = dist[:, -1]
+            density[start:start + chunkSize] = 1. / np.maximum(dist.mean(axis=1),
+                                                               np.finfo(np.float32).eps)
+        zNorm = np.linalg.norm(z, axis=1)
+
+        np.savez(self._getFileName('scores'), knnDist=knnDist,
+                 density=density, zNorm=zNorm, keep=self._getKeepMask(
+                     knnDist, density, zNorm))
+
+    def createOutputStep(self):
+        """ Create kept and rejected subsets with bulk copies. """
+        with np.load(self._getFileName('scores')) as scores:
+            keep, knnDist, density, zNorm = (
+                scores[key] for key in ['keep', 'knnDist', 'density', 'zNorm'])
+
+        for key, ind in [('kept_ind', np.flatnonzero(keep)),
+                         ('rejected_ind', np.flatnonzero(~keep))]:
+            with open(self._getFileName(key), 'wb') as f:
+                pickle.dump(ind.tolist(), f)
+
+        inputSet = self._getInputProt().Particles
+        outSets = []
+        for suffix in ['', 'Rejected']:
+            outSet = self._createSetOfParticlesFlex(suffix=suffix,
+                                                    progName=CRYODRGN)
+            outSet.copyInfo(inputSet)
+            outSet.setHasCTF(inputSet.hasCTF())
+            outSets.append(outSet)
+        keptSet, rejectedSet = outSets
+
+        for outSet, selected in [(keptSet, keep), (rejectedSet, ~keep)]:
+            outSet.copyItems(inputSet,
+                             updateItemCallback=self._setScores,
+                             itemDataIterator=zip(selected, knnDist,
+                                                  density, zNorm))
+
+        self._defineOutputs(**{outputs.Particles.name: keptSet,
+                               'ParticlesRejected': rejectedSet})
+        self._defineSourceRelation(inputSet, keptSet)
+        self._defineSourceRelation(inputSet, rejectedSet)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+
+        if self.isFinished():
+            summary.append(f"Kept particles: {self.Particles.getSize()}\n"
+                           f"Rejected particles: {self.ParticlesRejected.getSize()}")
+
+        return summary
+
+    def _validate(self):
+        errors = []
+
+        if not (self.doDensity or self.doKnnDist or self.doZNorm):
+            errors.append("Please choose at least one filtering criterion!")
+
+        if self.cutoffType == CUTOFF_QUANTILE:
+            for doParam, cutoff in [(self.doDensity, self.minDensity),
+                                    (self.doKnnDist, self.maxKnnDist),
+                                    (self.doZNorm, self.maxZNorm)]:
+                if doParam and not 0 <= cutoff.get() <= 1:
+                    errors.append("Quantile cutoffs must be between 0 and 1!")
+                    break
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getInputProt(self):
+        return self.inputProt.get()
+
+    def _getEpoch(self):
+        inputProt = self._getInputProt()
+        inputProt._createFilenameTemplates()
+        if self.inputEpoch == EPOCH_LAST:
+            return inputProt._getLastEpoch()
+
+        return self.epochNum.get() - 1
+
+    def _getKeepMask(self, knnDist, density, zNorm):
+        keep = np.ones(len(zNorm), dtype=bool)
+        if self.doDensity:
+            keep &= density >= self._getCutoff(density, self.minDensity.get())
+        if self.doKnnDist:
+            keep &= knnDist <= self._getCutoff(knnDist, self.maxKnnDist.get())
+        if self.doZNorm:
+            keep &= zNorm <= self._getCutoff(zNorm, self.maxZNorm.get())
+
+        return keep
+
+    def _getCutoff(self, scores, cutoff):
+        if self.cutoffType == CUTOFF_VALUE:
+            return cutoff
+
+        return np.quantile(scores, cutoff)
+
+    def _setScores(self, item, row):
+        selected, knnDist, density, zNorm = row
+        if not selected:
+            item._appendItem = False
+            return
+
+        setattr(item, KNN_DIST, pwobj.Float(float(knnDist)))
+        setattr(item, DENSITY, pwobj.Float(float(density)))
+        setattr(item, Z_NORM, pwobj.Float(float(zNorm)))
@@ -0,0 +1,206 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import NEW
+
+from cryodrgn.constants import (CRYODRGN, EPOCH_LAST, EPOCH_SELECTION,
+                                Z_VALUES, QUERY_VOLUMES, QUERY_COORDINATES,
+                                QUERY_NEAREST, QUERY_RADIUS)
+from cryodrgn.protocols.protocol_base import CryoDrgnProtBase
+from cryodrgn.utils import LatentIndex
+
+
+class CryoDrgnProtLatentSubset(CryoDrgnProtBase):
+    """ CryoDrgn protocol to extract particle subsets around volumes
+    or points of the latent space. """
+
+    _label = "latent space subset"
+    _devStatus = NEW
+    _possibleOutputs = None
+    doContinue = False
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputProt', params.PointerParam, important=True,
+                      pointerClass='CryoDrgnProtTrain, CryoDrgnProtAbinitio',
+                      label="Training run")
+        form.addParam('inputEpoch', params.EnumParam,
+                      choices=['last', 'selection'], default=EPOCH_LAST,
+                      display=params.EnumParam.DISPLAY_LIST,
+                      label="Epoch")
+        form.addParam('epochNum', params.IntParam,
+                      condition='inputEpoch==%d' % EPOCH_SELECTION,
+                      label="Epoch number")
+
+        form.addSection(label='Query')
+        form.addParam('querySource', params.EnumParam,
+                      choices=['volumes', 'z coordinates'],
+                      default=QUERY_VOLUMES,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Extract particles around")
+        form.addParam('inputVolumes', params.PointerParam,
+                      pointerClass='SetOfVolumes', allowsNull=True,
+                      condition='querySource==%d' % QUERY_VOLUMES,
+                      label="Volumes",
+                      help="Volumes with z values, e.g. k-means volumes from "
+                           "analyze results of the same epoch.")
+        form.addParam('zValues', params.TextParam, default='',
+                      condition='querySource==%d' % QUERY_COORDINATES,
+                      label="z coordinates",
+                      help="One latent point per line, values separated "
+                           "by spaces.")
+        form.addParam('queryMode', params.EnumParam,
+                      choices=['nearest', 'radius'], default=QUERY_NEAREST,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label="Select particles by")
+        form.addParam('numParticles', params.IntParam, default=10000,
+                      condition='queryMode==%d' % QUERY_NEAREST,
+                      validators=[params.Positive],
+                      label="Number of nearest particles")
+        form.addParam('radius', params.FloatParam, default=1.0,
+                      condition='queryMode==%d' % QUERY_RADIUS,
+                      validators=[params.Positive],
+                      label="Radius in latent space")
+        form.addParam('doMerge', params.BooleanParam, default=False,
+                      label="Merge subsets into one set?",
+                      help="Otherwise one subset is created per volume "
+                           "or z coordinate.")
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.buildIndexStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def buildIndexStep(self):
+        """ Build the latent index of the epoch, unless it already exists. """
+        self._loadIndex()
+
+    def createOutputStep(self):
+        """ Create the subsets in a single pass over the input particles. """
+        index = self._loadIndex()
+        points = self._getQueryPoints()
+        if self.queryMode == QUERY_NEAREST:
+            subsets = index.knn(points, self.numParticles.get())
+        else:
+            subsets = index.radius(points, self.radius.get())
+
+        if self.doMerge:
+            subsets = [np.unique(np.concatenate(subsets))]
+
+        members = dict()
+        for subset, indices in enumerate(subsets):
+            for i in indices:
+                members.setdefault(int(i), []).append(subset)
+
+        inputSet = self._getInputProt().Particles
+        outSets = []
+        for subset in range(len(subsets)):
+            suffix = '' if self.doMerge else f"_{subset+1:02d}"
+            outSet = self._createSetOfParticlesFlex(suffix=suffix,
+                                                    progName=CRYODRGN)
+            outSet.copyInfo(inputSet)
+            outSet.setHasCTF(inputSet.hasCTF())
+            outSets.append(outSet)
+
+        for i, particle in enumerate(inputSet):
+            for subset in members.get(i, []):
+                outSets[subset].append(particle)
+
+        for subset, outSet in enumerate(outSets):
+            name = "Particles" if self.doMerge else f"Particles_{subset+1:02d}"
+            self._defineOutputs(**{name: outSet})
+            self._defineSourceRelation(inputSet, outSet)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+
+        if self.isFinished():
+            sizes = [outSet.getSize() for _, outSet in self.iterOutputAttributes()]
+            summary.append(f"{len(sizes)} subsets with {', '.join(map(str, sizes))} "
+                           "particles.")
+
+        return summary
+
+    def _validate(self):
+        errors = []
+
+        if self.querySource == QUERY_VOLUMES and not self.inputVolumes.hasValue():
+            errors.append("Please provide input volumes!")
+            return errors
+
+        try:
+            points = self._getQueryPoints()
+        except (ValueError, TypeError, AttributeError):
+            points = None
+
+        if points is None or points.ndim != 2 or not points.size:
+            if self.querySource == QUERY_VOLUMES:
+                errors.append("Input volumes have no cryoDRGN z values!")
+            else:
+                errors.append("Please provide valid z coordinates!")
+        elif self.inputProt.hasValue():
+            zDim = self._getInputProt().getZDim()
+            if points.shape[1] != zDim:
+                errors.append(f"Query points have {points.shape[1]} values, "
+                              f"but the latent space of the input run has "
+                              f"{zDim} dimensions!")
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getInputProt(self):
+        return self.inputProt.get()
+
+    def _getEpoch(self):
+        inputProt = self._getInputProt()
+        inputProt._createFilenameTemplates()
+        if self.inputEpoch == EPOCH_LAST:
+            return inputProt._getLastEpoch()
+
+        return self.epochNum.get() - 1
+
+    def _loadIndex(self):
+        inputProt = self._getInputProt()
+        epoch = self._getEpoch()
+        return LatentIndex.load(inputProt._getFileName('z', epoch=epoch),
+                                inputProt._getFileName('latent_index', epoch=epoch))
+
+    def _getQueryPoints(self):
+        """ Return the query z values, one row per point. """
+        if self.querySource == QUERY_VOLUMES:
+            return np.array([[float(v) for v in getattr(vol, Z_VALUES)]
+                             for vol in self.inputVolumes.get()])
+
+        rows = [line.split() for line in self.zValues.get().splitlines()
+                if line.strip()]
+        return np.array(rows, dtype=float)
@@ -67,6 +67,7 @@ class CryoDrgnProtSubset(CryoDrgnProtBase):
         outImgSet = self._createSetOfParticlesFlex(progName=CRYODRGN)
         outImgSet.copyInfo(inputSet)
         outImgSet.setHasCTF(inputSet.hasCTF())
+        self._selection = set(self._getParticlesIndices())
         outImgSet.copyItems(inputSet, self._updateItem,
                             itemDataIterator=iter(range(inputSet.getSize())))
 
@@ -107,5 +108,5 @@ class CryoDrgnProtSubset(CryoDrgnProtBase):
         return x
 
     def _updateItem(self, item, index):
-        if index not in self._getParticlesIndices():
+        if index not in self._selection:
             item._appendItem = False
@@ -0,0 +1,159 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+import mrcfile
+import numpy as np
+
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import NEW
+from pwem.protocols import ProtAnalysis3D
+from pwem.objects import SetOfVolumes
+
+from cryodrgn.utils import fourierCrop
+
+
+class outputs(Enum):
+    Volumes = SetOfVolumes
+
+
+class CryoDrgnProtTransformVolumes(ProtAnalysis3D):
+    """ Flip handedness, invert contrast or downsample volumes generated
+    by cryoDRGN, without decoding them again. """
+
+    _label = "transform volumes"
+    _devStatus = NEW
+    _possibleOutputs = outputs
+
+    def _createFilenameTemplates(self):
+        """ Centralize how files are called within the protocol. """
+        myDict = {
+            'output_vol': self._getExtraPath('vol_%(id)03d.mrc')
+        }
+        self._updateFilenamesDict(myDict)
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolumes', params.PointerParam,
+                      pointerClass='SetOfVolumes', important=True,
+                      label="Input volumes",
+                      help="Usually volumes from cryoDRGN analyze results.")
+        form.addParam('doFlip', params.BooleanParam, default=False,
+                      label="Flip handedness")
+        form.addParam('doInvert', params.BooleanParam, default=False,
+                      label="Invert contrast")
+        form.addParam('doDownsample', params.BooleanParam, default=False,
+                      label="Downsample volumes?",
+                      help="Volumes are cropped in Fourier space.")
+        form.addParam('boxSize', params.IntParam, default=128,
+                      condition='doDownsample', label="New box size (px)")
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        self._insertFunctionStep(self.transformVolumesStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -----------------------------
+    def transformVolumesStep(self):
+        """ Transform all volumes concurrently on a thread pool. """
+        jobs = [(vol.getLocation(), self._getFileName('output_vol', id=vol.getObjId()))
+                for vol in self.inputVolumes.get()]
+
+        with ThreadPoolExecutor(max_workers=self.numberOfThreads.get()) as executor:
+            list(executor.map(lambda job: self._transformVolume(*job), jobs))
+
+    def createOutputStep(self):
+        inputSet = self.inputVolumes.get()
+        volSet = self._createSetOfVolumes()
+        volSet.copyInfo(inputSet)
+        volSet.setSamplingRate(self._getOutputSampling())
+        volSet.copyItems(inputSet, updateItemCallback=self._updateItem)
+
+        self._defineOutputs(**{outputs.Volumes.name: volSet})
+        self._defineSourceRelation(self.inputVolumes, volSet)
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+
+        if self.isFinished():
+            transforms = [name for name, done in
+                          [("flipped", self.doFlip), ("inverted", self.doInvert),
+                           (f"downsampled to {self.boxSize} px", self.doDownsample)]
+                          if done]
+            summary.append(f"{self.Volumes.getSize()} volumes "
+                           f"{', '.join(transforms)}.")
+
+        return summary
+
+    def _validate(self):
+        errors = []
+
+        if not (self.doFlip or self.doInvert or self.doDownsample):
+            errors.append("Please choose at least one transformation!")
+
+        if self.doDownsample:
+            if self.boxSize > self.inputVolumes.get().getXDim():
+                errors.append("You cannot upscale volumes!")
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+    def _transformVolume(self, location, outputFn):
+        index, inputFn = location
+        with mrcfile.mmap(inputFn.replace(':mrc', ''), mode='r',
+                          permissive=True) as mrc:
+            data = mrc.data[index - 1] if mrc.is_volume_stack() else mrc.data
+            vol = np.asarray(data, dtype=np.float32)
+
+        if self.doFlip:  # as cryodrgn eval_vol --flip
+            vol = vol[::-1]
+        if self.doInvert:
+            vol = -vol
+        if self.doDownsample:
+            vol = fourierCrop(vol, self.boxSize.get())
+
+        with mrcfile.new_mmap(outputFn, shape=vol.shape, mrc_mode=2,
+                              overwrite=True) as mrc:
+            mrc.data[:] = vol
+            mrc.voxel_size = self._getOutputSampling()
+
+    def _updateItem(self, item, row=None):
+        item.setLocation(self._getFileName('output_vol', id=item.getObjId()))
+        item.setSamplingRate(self._getOutputSampling())
+
+    def _getOutputSampling(self):
+        samplingRate = self.inputVolumes.get().getSamplingRate()
+        if self.doDownsample:
+            return samplingRate * self.inputVolumes.get().getXDim() / self.boxSize.get()
+
+        return samplingRate
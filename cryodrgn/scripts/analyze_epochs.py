@@ -0,0 +1,174 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Compare several training epochs in one pass.
+  prepare: convert z files to memory-mapped .npy once, choose k-means
+           anchor particles on the reference (last) epoch and write the
+           z values of the anchors for every epoch.
+  metrics: compute, in parallel across epochs, latent distances and
+           neighborhood stability against the reference epoch, and the
+           correlation of volumes generated at the anchors.
+"""
+
+import argparse
+import json
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from analyze_latent import runKmeans
+from mrcio import readMrc
+
+
+def getZ(outdir, epoch):
+    return np.load(os.path.join(outdir, f"z.{epoch}.npy"), mmap_mode="r")
+
+
+def prepare(args):
+    for epoch in args.epochs:
+        npyFile = os.path.join(args.o, f"z.{epoch}.npy")
+        if not os.path.exists(npyFile):
+            with open(os.path.join(args.workdir, f"z.{epoch}.pkl"), "rb") as f:
+                np.save(npyFile, np.asarray(pickle.load(f), dtype=np.float32))
+
+    zRef = getZ(args.o, args.epochs[-1])
+    anchors = runKmeans(zRef, args.anchors, args.chunk_size)[1]
+    np.savetxt(os.path.join(args.o, "anchors.txt"), anchors, fmt="%d")
+
+    for epoch in args.epochs:
+        epochDir = os.path.join(args.o, f"epoch{epoch:03d}")
+        os.makedirs(epochDir, exist_ok=True)
+        np.savetxt(os.path.join(epochDir, "z_anchors.txt"),
+                   getZ(args.o, epoch)[anchors])
+
+
+def getNeighbors(z, sample, k):
+    tree = cKDTree(z)
+    return tree.query(z[sample], k=k + 1)[1][:, 1:]
+
+
+def getVolumeCC(volFn, refFn):
+    vol = readMrc(volFn).ravel()
+    ref = readMrc(refFn).ravel()
+    return float(np.corrcoef(vol, ref)[0, 1])
+
+
+def getEpochMetrics(args, epoch, sample, refNeighbors, numAnchors):
+    zRef = getZ(args.o, args.epochs[-1])
+    z = getZ(args.o, epoch)
+    dist = np.empty(len(z), dtype=np.float32)
+    for start in range(0, len(z), args.chunk_size):
+        stop = min(start + args.chunk_size, len(z))
+        dist[start:stop] = np.linalg.norm(z[start:stop] - zRef[start:stop], axis=1)
+
+    neighbors = getNeighbors(z, sample, args.neighbors)
+    jaccard = [len(set(a) & set(b)) / len(set(a) | set(b))
+               for a, b in zip(neighbors, refNeighbors)]
+
+    metrics = {
+        "epoch": epoch + 1,
+        "latent_distance_mean": float(dist.mean()),
+        "latent_distance_median": float(np.median(dist)),
+        "neighborhood_stability": float(np.mean(jaccard))
+    }
+
+    if args.volumes:
+        volFn = lambda e, i: os.path.join(args.o, f"epoch{e:03d}", f"vol_{i:03d}.mrc")
+        cc = [getVolumeCC(volFn(epoch, i), volFn(args.epochs[-1], i))
+              for i in range(numAnchors)]
+        metrics["volume_cc"] = cc
+        metrics["volume_cc_mean"] = float(np.mean(cc))
+
+    return metrics
+
+
+def plotMetric(report, key, ylabel, fn):
+    epochs = [m["epoch"] for m in report]
+    plt.figure()
+    plt.plot(epochs, [m[key] for m in report], "o-")
+    plt.xlabel("Epoch")
+    plt.ylabel(ylabel)
+    plt.savefig(fn)
+    plt.close()
+
+
+def metrics(args):
+    zRef = getZ(args.o, args.epochs[-1])
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(len(zRef), min(args.sample, len(zRef)),
+                                replace=False))
+    refNeighbors = getNeighbors(zRef, sample, args.neighbors)
+    numAnchors = len(np.loadtxt(os.path.join(args.o, "anchors.txt"), ndmin=1))
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        report = list(executor.map(
+            lambda e: getEpochMetrics(args, e, sample, refNeighbors, numAnchors),
+            args.epochs))
+
+    with open(os.path.join(args.o, "convergence.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    plotMetric(report, "latent_distance_mean",
+               "Mean latent distance to last epoch",
+               os.path.join(args.o, "latent_distance.png"))
+    plotMetric(report, "neighborhood_stability",
+               f"Shared {args.neighbors} nearest neighbors (Jaccard)",
+               os.path.join(args.o, "neighborhood_stability.png"))
+    if args.volumes:
+        plotMetric(report, "volume_cc_mean",
+                   "Mean volume correlation to last epoch",
+                   os.path.join(args.o, "volume_correlation.png"))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("action", choices=["prepare", "metrics"])
+    parser.add_argument("workdir", help="Training output folder")
+    parser.add_argument("-o", required=True, help="Output folder")
+    parser.add_argument("--epochs", type=int, nargs="+", required=True,
+                        help="0-based epochs, the last one is the reference")
+    parser.add_argument("--anchors", type=int, default=20,
+                        help="Number of k-means anchor particles")
+    parser.add_argument("--neighbors", type=int, default=20)
+    parser.add_argument("--sample", type=int, default=10000,
+                        help="Particles used for neighborhood stability")
+    parser.add_argument("--volumes", action="store_true",
+                        help="Compare volumes generated at the anchors")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+    os.makedirs(args.o, exist_ok=True)
+    if args.action == "prepare":
+        prepare(args)
+    else:
+        metrics(args)
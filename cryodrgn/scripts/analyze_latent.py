@@ -0,0 +1,332 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Scalable latent space analysis for large datasets. Produces the same
+artifacts as cryodrgn analyze (without volumes): k-means samples,
+PC traversal z values, umap.pkl, plots and the notebooks. The z matrix is memory-mapped;
+PCA is incremental, k-means is mini-batch and UMAP is fitted on a
+stratified subsample and used to project the remaining points in
+parallel chunks. With --cache-dir, PCA, k-means and UMAP results are
+memoized and reused by later runs on the same z file.
+"""
+
+import argparse
+import os
+import re
+import json
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+
+from memo import Memo
+
+
+PLOT_POINTS = 200000  # max points in scatter plots
+UMAP_STRATA = 20  # k-means clusters used to stratify the UMAP subsample
+
+
+def loadZ(zFile, outdir):
+    """ Convert z.pkl to .npy once and return it memory-mapped. """
+    npyFile = os.path.join(outdir, "z.npy")
+    if not os.path.exists(npyFile):
+        with open(zFile, "rb") as f:
+            np.save(npyFile, np.asarray(pickle.load(f), dtype=np.float32))
+
+    return np.load(npyFile, mmap_mode="r")
+
+
+def iterChunks(n, chunkSize):
+    for start in range(0, n, chunkSize):
+        yield start, min(start + chunkSize, n)
+
+
+def runPCA(z, chunkSize):
+    """ Incremental PCA, returns projections and the fitted model. """
+    pca = IncrementalPCA(n_components=z.shape[1])
+    for start, stop in iterChunks(len(z), chunkSize):
+        if stop - start >= z.shape[1]:  # partial_fit needs n >= n_components
+            pca.partial_fit(z[start:stop])
+
+    pc = np.empty(z.shape, dtype=np.float32)
+    for start, stop in iterChunks(len(z), chunkSize):
+        pc[start:stop] = pca.transform(z[start:stop])
+
+    return pc, pca
+
+
+def runKmeans(z, k, chunkSize):
+    """ Mini-batch k-means, returns labels and on-data centers. """
+    kmeans = MiniBatchKMeans(n_clusters=k, batch_size=min(chunkSize, len(z)),
+                             n_init=3, random_state=0)
+    for start, stop in iterChunks(len(z), chunkSize):
+        if stop - start >= k:
+            kmeans.partial_fit(z[start:stop])
+
+    labels = np.empty(len(z), dtype=np.int64)
+    for start, stop in iterChunks(len(z), chunkSize):
+        labels[start:stop] = kmeans.predict(z[start:stop])
+
+    centersInd = getNearestPoints(z, kmeans.cluster_centers_, chunkSize)
+
+    return labels, centersInd
+
+
+def getNearestPoints(z, points, chunkSize):
+    """ Return indices of the data points closest to each point. """
+    points = np.asarray(points, dtype=np.float32)
+    best = np.full(len(points), np.inf)
+    ind = np.zeros(len(points), dtype=np.int64)
+    pointsNorm = (points ** 2).sum(axis=1)
+
+    for start, stop in iterChunks(len(z), chunkSize):
+        chunk = np.asarray(z[start:stop])
+        dist = ((chunk ** 2).sum(axis=1)[:, None] - 2 * chunk @ points.T
+                + pointsNorm[None, :])
+        rows = dist.argmin(axis=0)
+        dmin = dist[rows, np.arange(len(points))]
+        better = dmin < best
+        best[better] = dmin[better]
+        ind[better] = rows[better] + start
+
+    return ind
+
+
+def getStratifiedSample(labels, size, seed=0):
+    """ Sample indices keeping the proportion of each k-means cluster. """
+    if size >= len(labels):
+        return np.arange(len(labels))
+
+    rng = np.random.default_rng(seed)
+    sample = []
+    for k, count in enumerate(np.bincount(labels)):
+        if count:
+            quota = min(count, max(1, round(count * size / len(labels))))
+            sample.append(rng.choice(np.flatnonzero(labels == k), quota,
+                                     replace=False))
+
+    return np.sort(np.concatenate(sample))
+
+
+def runUmap(z, labels, sampleSize, chunkSize, threads):
+    """ Fit UMAP on a stratified subsample and project the rest. """
+    import umap
+    sample = getStratifiedSample(labels, sampleSize)
+    reducer = umap.UMAP()
+    emb = np.empty((len(z), 2), dtype=np.float32)
+    emb[sample] = reducer.fit_transform(np.asarray(z[sample]))
+
+    rest = np.setdiff1d(np.arange(len(z)), sample, assume_unique=True)
+    if len(rest):
+        # the first transform builds the search index, do it serially
+        chunks = [rest[start:stop] for start, stop in iterChunks(len(rest), chunkSize)]
+        emb[chunks[0]] = reducer.transform(np.asarray(z[chunks[0]]))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = executor.map(lambda c: reducer.transform(np.asarray(z[c])),
+                                   chunks[1:])
+            for chunk, result in zip(chunks[1:], results):
+                emb[chunk] = result
+
+    return emb
+
+
+def getPcTrajectories(pc, pca, numPcs, numPoints=10):
+    """ Points along each PC between its 5th and 95th percentiles,
+    as cryodrgn analyze does. """
+    trajectories = []
+    for i in range(numPcs):
+        start, end = np.percentile(pc[:, i], (5, 95))
+        traj = np.zeros((numPoints, pc.shape[1]))
+        traj[:, i] = np.linspace(start, end, numPoints)
+        trajectories.append(pca.inverse_transform(traj))
+
+    return trajectories
+
+
+def plotScatter(x, y, fn, hexFn=None, xlabel=None, ylabel=None,
+                centers=None):
+    """ Scatter and hexbin plots, with the points of the centers
+    indices annotated if given. """
+    step = max(1, len(x) // PLOT_POINTS)
+    plt.figure(figsize=(6, 6))
+    plt.scatter(x[::step], y[::step], s=1, alpha=0.1, rasterized=True)
+    annotateCenters(x, y, centers)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.savefig(fn)
+    plt.close()
+
+    if hexFn:
+        plt.figure(figsize=(6, 6))
+        plt.hexbin(x, y, gridsize=100, bins="log", cmap="viridis")
+        annotateCenters(x, y, centers)
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+        plt.savefig(hexFn)
+        plt.close()
+
+
+def annotateCenters(x, y, centers):
+    if centers is None:
+        return
+    plt.scatter(x[centers], y[centers], c="cornflowerblue", edgecolor="k")
+    for i, ind in enumerate(centers):
+        plt.annotate(str(i), (x[ind], y[ind]))
+
+
+def copyNotebooks(outdir, epoch, ksample):
+    """ Copy the cryoDRGN notebook templates with the epoch and
+    k-means values filled in, as cryodrgn analyze does. """
+    import cryodrgn
+    templatesDir = os.path.join(os.path.dirname(cryodrgn.__file__), "templates")
+    for name in ["cryoDRGN_viz", "cryoDRGN_filtering", "cryoDRGN_figures"]:
+        template = os.path.join(templatesDir, f"{name}_template.ipynb")
+        outFn = os.path.join(outdir, f"{name}.ipynb")
+        if not os.path.exists(template) or os.path.exists(outFn):
+            continue
+
+        with open(template) as f:
+            notebook = json.load(f)
+        for cell in notebook["cells"]:
+            source = "".join(cell["source"])
+            source = source.replace("EPOCH = None", f"EPOCH = {epoch}")
+            source = source.replace("KMEANS = None", f"KMEANS = {ksample}")
+            cell["source"] = source.splitlines(keepends=True)
+        with open(outFn, "w") as f:
+            json.dump(notebook, f, indent=1)
+
+
+def plotPcOnUmap(emb, pc, pcInd, outdir, i):
+    step = max(1, len(emb) // PLOT_POINTS)
+    plt.figure(figsize=(6, 6))
+    sc = plt.scatter(emb[::step, 0], emb[::step, 1], c=pc[::step, i], s=1,
+                     cmap="viridis", rasterized=True)
+    plt.colorbar(sc, label=f"PC{i+1}")
+    plt.xlabel("UMAP1")
+    plt.ylabel("UMAP2")
+    plt.savefig(os.path.join(outdir, "umap.png"))
+    plt.close()
+
+    plt.figure(figsize=(6, 6))
+    plt.scatter(emb[::step, 0], emb[::step, 1], s=1, alpha=0.1,
+                color="grey", rasterized=True)
+    plt.plot(emb[pcInd, 0], emb[pcInd, 1], "--", color="k")
+    plt.scatter(emb[pcInd, 0], emb[pcInd, 1], c="cornflowerblue",
+                edgecolor="k")
+    for j, ind in enumerate(pcInd):
+        plt.annotate(str(j), (emb[ind, 0], emb[ind, 1]))
+    plt.xlabel("UMAP1")
+    plt.ylabel("UMAP2")
+    plt.savefig(os.path.join(outdir, "umap_traversal_connected.png"))
+    plt.close()
+
+
+def main(args):
+    os.makedirs(args.o, exist_ok=True)
+    z = loadZ(args.zfile, args.o)
+    zdim = z.shape[1]
+    memo = Memo(args.cache_dir, args.zfile)
+    chunkSize = args.chunk_size
+
+    print("Running incremental PCA...", flush=True)
+    pc, pca = memo.get("pca", {"chunk": chunkSize},
+                       lambda: runPCA(z, chunkSize))
+    np.save(os.path.join(args.o, "pc_projections.npy"), pc)
+    plotScatter(pc[:, 0], pc[:, 1], os.path.join(args.o, "z_pca.png"),
+                os.path.join(args.o, "z_pca_hex.png"), "PC1", "PC2")
+
+    print("Running mini-batch k-means...", flush=True)
+    labels, centersInd = memo.get("kmeans", {"k": args.ksample, "chunk": chunkSize},
+                                  lambda: runKmeans(z, args.ksample, chunkSize))
+    kmeansDir = os.path.join(args.o, f"kmeans{args.ksample}")
+    os.makedirs(kmeansDir, exist_ok=True)
+    with open(os.path.join(kmeansDir, "labels.pkl"), "wb") as f:
+        pickle.dump(labels, f)
+    np.savetxt(os.path.join(kmeansDir, "centers.txt"), z[centersInd])
+    np.savetxt(os.path.join(kmeansDir, "centers_ind.txt"), centersInd, fmt="%d")
+    plotScatter(pc[:, 0], pc[:, 1], os.path.join(kmeansDir, "z_pca.png"),
+                os.path.join(kmeansDir, "z_pca_hex.png"), "PC1", "PC2",
+                centers=centersInd)
+
+    emb = None
+    if zdim > 2:
+        print("Running UMAP...", flush=True)
+        # stratify on a fixed k, so the embedding does not depend on ksample
+        strata = memo.get("kmeans", {"k": UMAP_STRATA, "chunk": chunkSize},
+                          lambda: runKmeans(z, UMAP_STRATA, chunkSize))[0]
+        emb = memo.get("umap", {"sample": args.umap_sample, "chunk": chunkSize,
+                                "strata": UMAP_STRATA},
+                       lambda: runUmap(z, strata, args.umap_sample, chunkSize,
+                                       args.threads))
+        with open(os.path.join(args.o, "umap.pkl"), "wb") as f:
+            pickle.dump(emb, f)
+        plotScatter(emb[:, 0], emb[:, 1], os.path.join(args.o, "umap.png"),
+                    os.path.join(args.o, "umap_hex.png"), "UMAP1", "UMAP2")
+        plotScatter(emb[:, 0], emb[:, 1], os.path.join(kmeansDir, "umap.png"),
+                    os.path.join(kmeansDir, "umap_hex.png"), "UMAP1", "UMAP2",
+                    centers=centersInd)
+
+    trajectories = getPcTrajectories(pc, pca, args.pc)
+    for i, zPc in enumerate(trajectories):
+        pcDir = os.path.join(args.o, f"pc{i+1}")
+        os.makedirs(pcDir, exist_ok=True)
+        np.savetxt(os.path.join(pcDir, "z_values.txt"), zPc)
+        if emb is not None:
+            pcInd = getNearestPoints(z, zPc, args.chunk_size)
+            plotPcOnUmap(emb, pc, pcInd, pcDir, i)
+
+    epoch = args.epoch
+    if epoch is None:
+        epoch = int(re.search(r"z\.(\d+)\.pkl$", args.zfile).group(1))
+    copyNotebooks(args.o, epoch, args.ksample)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("zfile", help="Input z.pkl")
+    parser.add_argument("-o", required=True, help="Output folder")
+    parser.add_argument("--epoch", type=int, default=None,
+                        help="Epoch of the z file, parsed from its name "
+                             "if not given")
+    parser.add_argument("--ksample", type=int, default=20,
+                        help="Number of k-means samples")
+    parser.add_argument("--pc", type=int, default=2,
+                        help="Number of principal components to traverse")
+    parser.add_argument("--umap-sample", type=int, default=100000,
+                        help="Number of particles used to fit UMAP")
+    parser.add_argument("--chunk-size", type=int, default=100000,
+                        help="Number of particles processed at once")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Threads for UMAP projection")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder to memoize PCA, k-means and UMAP results")
+    main(parser.parse_args())
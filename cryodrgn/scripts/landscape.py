@@ -0,0 +1,274 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Streaming conformational landscape analysis. Produces the same
+artifacts as cryodrgn analyze_landscape while keeping memory bounded
+regardless of the number of volumes: the masked voxels of every
+volume are written once into a memory-mapped matrix, volume PCA is
+incremental and state mean volumes are accumulated one volume at a time.
+
+  sketch:  k-means on z, giving the z values of the volumes to generate
+  analyze: mask, volume PCA, then clustering into states and plots
+           for every requested clustering setting
+"""
+
+import argparse
+import os
+import pickle
+import numpy as np
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from scipy import ndimage
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.decomposition import IncrementalPCA
+
+from analyze_latent import loadZ, runKmeans, iterChunks
+from memo import Memo
+from mrcio import readMrc, writeMrc
+
+
+def getVolumeFiles(volDir, numVols):
+    return [os.path.join(volDir, f"vol_{i:03d}.mrc") for i in range(numVols)]
+
+
+def getMask(volFiles, maskFile=None, thresh=None, dilate=5):
+    """ Return the boolean mask: the custom one or the mean volume
+    thresholded (default half of its max) and dilated. """
+    if maskFile:
+        return readMrc(maskFile) > 0.5
+
+    mean = None
+    for fn in volFiles:
+        vol = readMrc(fn).astype(np.float64)
+        mean = vol if mean is None else mean + vol
+    mean /= len(volFiles)
+
+    mask = mean > (thresh if thresh else mean.max() / 2)
+    if dilate:
+        mask = ndimage.distance_transform_edt(~mask) <= dilate
+
+    return mask
+
+
+def loadMasked(volFiles, mask, outFn):
+    """ Write the masked voxels of each volume as one row of a
+    memory-mapped matrix. """
+    data = np.lib.format.open_memmap(outFn, mode="w+", dtype=np.float32,
+                                     shape=(len(volFiles), int(mask.sum())))
+    for i, fn in enumerate(volFiles):
+        data[i] = readMrc(fn)[mask]
+    data.flush()
+
+    return data
+
+
+def runVolumePCA(data, pcDim, chunkSize=None):
+    """ Incremental PCA of the volume rows, reading chunkSize rows
+    at a time (by default max(2 * pcDim, 50)) to bound memory. """
+    pcDim = min(pcDim, len(data))
+    chunkSize = max(chunkSize or max(2 * pcDim, 50), pcDim)
+    pca = IncrementalPCA(n_components=pcDim)
+    for start, stop in iterChunks(len(data), chunkSize):
+        if stop - start >= pcDim:
+            pca.partial_fit(data[start:stop])
+
+    pc = np.empty((len(data), pcDim), dtype=np.float32)
+    for start, stop in iterChunks(len(data), chunkSize):
+        pc[start:stop] = pca.transform(data[start:stop])
+
+    return pc, pca
+
+
+def getStateMeans(volFiles, stateLabels):
+    """ Accumulate the mean volume of each state. """
+    sums, counts = {}, np.bincount(stateLabels)
+    for fn, state in zip(volFiles, stateLabels):
+        vol = readMrc(fn).astype(np.float64)
+        if state in sums:
+            sums[state] += vol
+        else:
+            sums[state] = vol
+
+    return {state: (sums[state] / counts[state]).astype(np.float32)
+            for state in sums}
+
+
+def plotCounts(counts, ylabel, fn):
+    plt.figure(figsize=(6, 4))
+    plt.bar(np.arange(1, len(counts) + 1), counts)
+    plt.xlabel("State")
+    plt.ylabel(ylabel)
+    plt.savefig(fn)
+    plt.close()
+
+
+def plotStates(emb, particleStates, volInd, volStates, outdir):
+    numStates = int(volStates.max()) + 1
+    cmap = plt.get_cmap("tab20", max(numStates, 2))
+    step = max(1, len(emb) // 200000)
+
+    plt.figure(figsize=(6, 6))
+    plt.scatter(emb[::step, 0], emb[::step, 1], c=particleStates[::step],
+                cmap=cmap, vmin=-0.5, vmax=numStates - 0.5, s=1, alpha=0.2,
+                rasterized=True)
+    plt.xlabel("UMAP1")
+    plt.ylabel("UMAP2")
+    plt.savefig(os.path.join(outdir, "umap.png"))
+    plt.close()
+
+    plt.figure(figsize=(6, 6))
+    plt.scatter(emb[::step, 0], emb[::step, 1], s=1, alpha=0.05,
+                color="grey", rasterized=True)
+    plt.scatter(emb[volInd, 0], emb[volInd, 1], c=volStates, cmap=cmap,
+                vmin=-0.5, vmax=numStates - 0.5, s=10, edgecolor="k",
+                linewidths=0.2)
+    for state in range(numStates):
+        ind = volInd[volStates == state]
+        if len(ind):
+            x, y = np.median(emb[ind], axis=0)
+            plt.annotate(str(state + 1), (x, y), weight="bold")
+    plt.xlabel("UMAP1")
+    plt.ylabel("UMAP2")
+    plt.savefig(os.path.join(outdir, "umap_annotated.png"))
+    plt.close()
+
+
+def sketch(args):
+    z = loadZ(args.zfile, args.o)
+    memo = Memo(args.cache_dir, args.zfile)
+    print("Running k-means...", flush=True)
+    labels, centersInd = memo.get("kmeans", {"k": args.N, "chunk": args.chunk_size},
+                                  lambda: runKmeans(z, args.N, args.chunk_size))
+    kmeansDir = os.path.join(args.o, f"kmeans{args.N}")
+    os.makedirs(kmeansDir, exist_ok=True)
+    with open(os.path.join(kmeansDir, "labels.pkl"), "wb") as f:
+        pickle.dump(labels, f)
+    np.savetxt(os.path.join(kmeansDir, "centers.txt"), z[centersInd])
+    np.savetxt(os.path.join(kmeansDir, "centers_ind.txt"), centersInd, fmt="%d")
+
+
+def analyze(args):
+    kmeansDir = os.path.join(args.o, f"kmeans{args.N}")
+    volFiles = getVolumeFiles(kmeansDir, args.N)
+
+    print("Masking volumes...", flush=True)
+    mask = getMask(volFiles, args.mask, args.thresh, args.dilate)
+    writeMrc(os.path.join(args.o, "mask.mrc"), mask.astype(np.float32), args.Apix)
+    data = loadMasked(volFiles, mask, os.path.join(args.o, "vols_masked.npy"))
+
+    print("Running incremental volume PCA...", flush=True)
+    pc, pca = runVolumePCA(data, args.pc_dim, args.chunk_size)
+    np.save(os.path.join(args.o, "vol_pca.npy"), pc)
+    with open(os.path.join(args.o, "vol_pca_obj.pkl"), "wb") as f:
+        pickle.dump(pca, f)
+
+    with open(os.path.join(kmeansDir, "labels.pkl"), "rb") as f:
+        particleLabels = np.asarray(pickle.load(f))
+    emb, volInd = None, None
+    umapFn = os.path.join(args.o, "umap.pkl")
+    if os.path.exists(umapFn):
+        with open(umapFn, "rb") as f:
+            emb = np.asarray(pickle.load(f))
+        volInd = np.loadtxt(os.path.join(kmeansDir, "centers_ind.txt"),
+                            dtype=np.int64, ndmin=1)
+
+    for linkage, numStates in args.clustering:
+        print(f"Clustering volumes: {linkage} linkage, {numStates} states...",
+              flush=True)
+        cluster(pc, volFiles, particleLabels, emb, volInd, linkage,
+                numStates, args)
+
+
+def cluster(pc, volFiles, particleLabels, emb, volInd, linkage, numStates, args):
+    """ Assign volumes to states and write the outputs of one setting. """
+    volStates = AgglomerativeClustering(n_clusters=numStates,
+                                        linkage=linkage).fit_predict(pc)
+    clusterDir = os.path.join(args.o, f"clustering_L2_{linkage}_{numStates}")
+    os.makedirs(clusterDir, exist_ok=True)
+    with open(os.path.join(clusterDir, "state_labels.pkl"), "wb") as f:
+        pickle.dump(volStates, f)
+
+    for state, vol in getStateMeans(volFiles, volStates).items():
+        writeMrc(os.path.join(clusterDir, f"state_{state}_mean.mrc"), vol,
+                 args.Apix)
+
+    particleStates = volStates[particleLabels]
+    plotCounts(np.bincount(volStates, minlength=numStates), "Volumes",
+               os.path.join(clusterDir, "state_volume_counts.png"))
+    plotCounts(np.bincount(particleStates, minlength=numStates), "Particles",
+               os.path.join(clusterDir, "state_particle_counts.png"))
+
+    if emb is not None:
+        plotStates(emb, particleStates, volInd, volStates, clusterDir)
+
+
+def parseClustering(value):
+    """ Parse a linkage:clusters setting, e.g. ward:10 """
+    linkage, numStates = value.split(":")
+    return linkage, int(numStates)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sub = subparsers.add_parser("sketch")
+    sub.add_argument("zfile", help="Input z.pkl")
+    sub.add_argument("-o", required=True, help="Output folder")
+    sub.add_argument("-N", type=int, required=True,
+                     help="Number of volumes to generate")
+    sub.add_argument("--chunk-size", type=int, default=100000,
+                     help="Number of particles processed at once")
+    sub.add_argument("--cache-dir", default=None,
+                     help="Folder to memoize k-means results")
+
+    sub = subparsers.add_parser("analyze")
+    sub.add_argument("-o", required=True, help="Landscape folder")
+    sub.add_argument("-N", type=int, required=True,
+                     help="Number of generated volumes")
+    sub.add_argument("--clustering", type=parseClustering, nargs="+",
+                     required=True,
+                     help="Clustering settings as linkage:states, e.g. "
+                          "ward:10 average:10. Volume PCA is shared by all")
+    sub.add_argument("--pc-dim", type=int, default=20)
+    sub.add_argument("--Apix", type=float, default=1.)
+    sub.add_argument("--mask", default=None, help="Custom mask (.mrc)")
+    sub.add_argument("--thresh", type=float, default=None,
+                     help="Masking threshold (default: half of max density)")
+    sub.add_argument("--dilate", type=int, default=5,
+                     help="Dilate the initial mask by this amount (px)")
+    sub.add_argument("--chunk-size", type=int, default=None,
+                     help="Number of volumes per incremental PCA batch, "
+                          "max(2 * pc-dim, 50) by default")
+
+    args = parser.parse_args()
+    if args.command == "sketch":
+        sketch(args)
+    else:
+        analyze(args)
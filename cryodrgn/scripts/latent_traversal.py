@@ -0,0 +1,133 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Scalable graph traversal between anchor particles, equivalent to
+cryodrgn graph_traversal. The nearest neighbor graph is built from an
+approximate KD-tree query run in parallel chunks and stored as a sparse
+matrix, then Dijkstra's algorithm finds the shortest path between
+consecutive anchors.
+"""
+
+import argparse
+import os
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from memo import Memo
+
+
+def queryNeighbors(z, k, eps, chunkSize, threads):
+    """ Return distances and indices of the k nearest neighbors
+    of every point (excluding itself). """
+    tree = cKDTree(z)
+    dists = np.empty((len(z), k), dtype=np.float32)
+    inds = np.empty((len(z), k), dtype=np.int64)
+    for start in range(0, len(z), chunkSize):
+        stop = min(start + chunkSize, len(z))
+        d, i = tree.query(z[start:stop], k=k + 1, eps=eps, workers=threads)
+        dists[start:stop], inds[start:stop] = d[:, 1:], i[:, 1:]
+
+    return dists, inds
+
+
+def buildGraph(dists, inds, avgNeighbors):
+    """ Keep the edges shorter than the distance cutoff that gives
+    avgNeighbors neighbors per point on average. """
+    n, k = dists.shape
+    numEdges = min(n * avgNeighbors, dists.size)
+    cutoff = np.partition(dists.ravel(), numEdges - 1)[numEdges - 1]
+    keep = dists <= cutoff
+    rows = np.repeat(np.arange(n), k)[keep.ravel()]
+    graph = csr_matrix((dists[keep], (rows, inds[keep])), shape=(n, n))
+
+    return graph.maximum(graph.T)
+
+
+def findPath(graph, anchors):
+    """ Concatenate the shortest paths between consecutive anchors. """
+    path = [anchors[0]]
+    for src, dst in zip(anchors[:-1], anchors[1:]):
+        dist, pred = dijkstra(graph, directed=False, indices=src,
+                              return_predecessors=True)
+        if np.isinf(dist[dst]):
+            print(f"WARNING: no path from {src} to {dst}, "
+                  "jumping directly to the next anchor.", flush=True)
+            path.append(dst)
+            continue
+
+        segment = []
+        node = dst
+        while node != src:
+            segment.append(node)
+            node = pred[node]
+        path.extend(segment[::-1])
+
+    return np.array(path, dtype=np.int64)
+
+
+def main(args):
+    with open(args.zfile, "rb") as f:
+        z = np.asarray(pickle.load(f), dtype=np.float32)
+    anchors = np.loadtxt(args.anchors, dtype=np.int64, ndmin=1).tolist()
+    memo = Memo(args.cache_dir, args.zfile)
+
+    print("Building nearest neighbor graph...", flush=True)
+    dists, inds = memo.get("knn", {"k": args.max_neighbors, "eps": args.eps},
+                           lambda: queryNeighbors(z, args.max_neighbors, args.eps,
+                                                  args.chunk_size, args.threads))
+    graph = buildGraph(dists, inds, args.avg_neighbors)
+
+    print("Finding shortest paths between anchors...", flush=True)
+    path = findPath(graph, anchors)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.outind)), exist_ok=True)
+    np.savetxt(args.outind, path, fmt="%d")
+    np.savetxt(args.outtxt, z[path])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("zfile", help="Input z.pkl")
+    parser.add_argument("--anchors", required=True,
+                        help="Text file with anchor particle indices")
+    parser.add_argument("--outind", required=True,
+                        help="Output text file with path indices")
+    parser.add_argument("--outtxt", required=True,
+                        help="Output text file with path z values")
+    parser.add_argument("--max-neighbors", type=int, default=10)
+    parser.add_argument("--avg-neighbors", type=int, default=5)
+    parser.add_argument("--eps", type=float, default=0.1,
+                        help="Relative tolerance of the approximate "
+                             "neighbor search (0 for exact)")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder to memoize the neighbor graph")
+    main(parser.parse_args())
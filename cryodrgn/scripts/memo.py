@@ -0,0 +1,75 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Memoization of expensive latent space analysis intermediates
+(PCA, k-means, UMAP, kNN graph), keyed by the z file content
+and the parameters of each computation.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+
+def hashFile(fn):
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class Memo:
+    def __init__(self, cacheDir, zFile):
+        """ If cacheDir is None, results are always computed. """
+        self.path = None
+        if cacheDir:
+            self.path = os.path.join(cacheDir, hashFile(zFile))
+
+    def get(self, kind, params, compute):
+        """ Return the cached result of compute() for these
+        kind and params, computing and storing it on a miss. """
+        if self.path is None:
+            return compute()
+
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        fn = os.path.join(self.path, f"{kind}_{key[:16]}.pkl")
+        if os.path.exists(fn):
+            print(f"Reusing cached {kind} {params}", flush=True)
+            with open(fn, "rb") as f:
+                return pickle.load(f)
+
+        result = compute()
+        os.makedirs(self.path, exist_ok=True)
+        tmpFn = f"{fn}.{os.getpid()}.tmp"
+        with open(tmpFn, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFn, fn)
+
+        return result
@@ -0,0 +1,45 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+MRC input/output with cryoDRGN's own readers and writers,
+which moved between cryoDRGN versions.
+"""
+
+try:  # cryodrgn >= 3.4
+    from cryodrgn.mrcfile import parse_mrc, write_mrc
+except ImportError:
+    from cryodrgn.mrc import parse_mrc, MRCFile
+    write_mrc = MRCFile.write
+
+
+def readMrc(fn):
+    """ Return the volume data as a numpy array. """
+    return parse_mrc(fn)[0]
+
+
+def writeMrc(fn, data, apix=1.):
+    write_mrc(fn, data, Apix=apix)
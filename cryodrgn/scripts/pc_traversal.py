@@ -0,0 +1,63 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Write z values of the PC traversals the same way cryodrgn analyze does,
+so that volumes can be generated in separate steps. The PCA projections
+of all particles are saved as well (pc_projections.npy), so that they
+have the same axes and signs as the traversals.
+"""
+
+import argparse
+import os
+import numpy as np
+
+from cryodrgn import analysis, utils
+
+
+def main(args):
+    z = utils.load_pkl(args.zfile)
+    pc, pca = analysis.run_pca(z)
+    np.save(os.path.join(args.o, "pc_projections.npy"),
+            np.asarray(pc, dtype=np.float32))
+
+    for i in range(args.pc):
+        start, end = np.percentile(pc[:, i], (5, 95))
+        zPc = analysis.get_pc_traj(pca, z.shape[1], args.n, i + 1, start, end)
+        outdir = os.path.join(args.o, f"pc{i+1}")
+        os.makedirs(outdir, exist_ok=True)
+        np.savetxt(os.path.join(outdir, "z_values.txt"), zPc)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("zfile", help="Input z.pkl")
+    parser.add_argument("-o", required=True, help="Analysis output folder")
+    parser.add_argument("--pc", type=int, default=2,
+                        help="Number of principal components")
+    parser.add_argument("-n", type=int, default=10,
+                        help="Number of points along each PC")
+    main(parser.parse_args())
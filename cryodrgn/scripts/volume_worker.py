@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Long-lived volume generation worker. Loads the cryoDRGN model once and
+decodes batches of z values received over a local unix socket, one
+JSON request per line:
+    {"z": [[...], ...], "outdir": ..., "apix": 1, "flip": false,
+     "invert": false, "downsample": null}
+and replies with {"files": [...]} or {"error": "..."}.
+The worker exits after being idle for --idle-timeout seconds.
+"""
+
+import argparse
+import json
+import os
+import socket
+import numpy as np
+import torch
+
+from cryodrgn import config
+from cryodrgn.models import HetOnlyVAE
+
+from mrcio import writeMrc
+
+
+class VolumeGenerator:
+    def __init__(self, weights, configFn):
+        cfg = config.load(configFn)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model, self.lattice = HetOnlyVAE.load(cfg, weights, device=self.device)
+        self.model.eval()
+        self.norm = [float(x) for x in cfg["dataset_args"]["norm"]]
+        self.zdim = cfg["model_args"]["zdim"]
+
+    def generate(self, z, outdir, apix=1, flip=False, invert=False,
+                 downsample=None, prefix="vol_"):
+        """ Decode volumes as cryodrgn eval_vol does. """
+        lattice = self.lattice
+        D = lattice.D
+        if downsample:
+            coords = lattice.get_downsample_coords(downsample + 1)
+            size, extent = downsample + 1, lattice.extent * downsample / (D - 1)
+            apix = apix * (D - 1) / downsample
+        else:
+            coords, size, extent = lattice.coords, D, lattice.extent
+
+        os.makedirs(outdir, exist_ok=True)
+        z = np.asarray(z, dtype=np.float32).reshape(-1, self.zdim)
+        files = []
+        with torch.no_grad():
+            for i, zz in enumerate(z):
+                vol = self.model.decoder.eval_volume(coords, size, extent,
+                                                     self.norm, zz)
+                vol = vol.cpu().numpy() if torch.is_tensor(vol) else np.asarray(vol)
+                if flip:
+                    vol = vol[::-1]
+                if invert:
+                    vol = -vol
+                fn = os.path.join(outdir, f"{prefix}{i:03d}.mrc")
+                writeMrc(fn, np.ascontiguousarray(vol, dtype=np.float32), apix)
+                files.append(fn)
+
+        return files
+
+
+def serve(generator, address, idleTimeout):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(address)
+    os.chmod(address, 0o600)
+    server.listen()
+    server.settimeout(idleTimeout)
+
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                print(f"Idle for {idleTimeout} s, exiting.", flush=True)
+                break
+
+            with conn:
+                conn.settimeout(None)
+                with conn.makefile("rb") as f:
+                    line = f.readline()
+                if not line:  # liveness check of a client
+                    continue
+                try:
+                    request = json.loads(line)
+                    files = generator.generate(
+                        request["z"], request["outdir"],
+                        apix=request.get("apix", 1),
+                        flip=request.get("flip", False),
+                        invert=request.get("invert", False),
+                        downsample=request.get("downsample"))
+                    reply = {"files": files}
+                except Exception as e:
+                    reply = {"error": f"{type(e).__name__}: {e}"}
+                try:
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                except OSError:  # client gone, keep serving
+                    pass
+    finally:
+        server.close()
+        if os.path.exists(address):
+            os.remove(address)
+
+
+def main(args):
+    generator = VolumeGenerator(args.weights, args.config)
+    print(f"Model loaded on {generator.device}, listening on {args.socket}",
+          flush=True)
+    serve(generator, args.socket, args.idle_timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("weights", help="Model weights")
+    parser.add_argument("-c", "--config", required=True, help="config.yaml")
+    parser.add_argument("--socket", required=True, help="Unix socket path")
+    parser.add_argument("--idle-timeout", type=float, default=600,
+                        help="Exit after this many seconds without requests")
+    main(parser.parse_args())
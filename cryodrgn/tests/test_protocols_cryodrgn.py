@@ -24,13 +24,22 @@
 # *
 # **************************************************************************
 
+import json
+import os
+
+import numpy as np
+
 from pyworkflow.tests import DataSet, setupTestProject
 from pyworkflow.utils import magentaStr
 from pwem.protocols import ProtImportParticles
 from pwem.tests.workflows import TestWorkflow
 
 from cryodrgn.protocols import (CryoDrgnProtPreprocess, CryoDrgnProtTrain,
-                                CryoDrgnProtAbinitio, CryoDrgnProtAnalyze)
+                                CryoDrgnProtAbinitio, CryoDrgnProtAnalyze,
+                                CryoDrgnProtConvergence,
+                                CryoDrgnProtTransformVolumes,
+                                CryoDrgnProtLatentSubset, CryoDrgnProtFilter)
+from cryodrgn.utils import generateVolumes, getVolumeName, VolumeWorker
 
 
 class TestWorkflowCryoDrgn(TestWorkflow):
@@ -82,6 +91,30 @@ class TestWorkflowCryoDrgn(TestWorkflow):
 
         return self.launchProtocol(protAnalyze)
 
+    def _runConvergence(self, protTrain, **kwargs):
+        print(magentaStr("\n==> Testing cryoDRGN - analyze convergence:"))
+        protConvergence = self.newProtocol(CryoDrgnProtConvergence, **kwargs)
+        protConvergence.inputProt.set(protTrain)
+
+        return self.launchProtocol(protConvergence)
+
+    def _testVolumeWorker(self, protTrain):
+        print(magentaStr("\n==> Testing cryoDRGN - volume worker:"))
+        protTrain._createFilenameTemplates()
+        weights = protTrain._getFileName('weights',
+                                         epoch=protTrain._getLastEpoch())
+        config = protTrain._getFileName('config')
+        worker = VolumeWorker(weights, config)
+
+        # the first request starts the worker, the second one reuses it
+        for i in range(2):
+            outdir = self.proj.getTmpPath(f'worker_volumes{i}')
+            generateVolumes(np.full((2, 2), i), weights, config, outdir,
+                            useWorker=True)
+            for j in range(2):
+                self.assertTrue(os.path.exists(getVolumeName(outdir, j)))
+            self.assertTrue(worker._isAlive())
+
     def testWorkflow(self):
         protImport = self._importParticles(self.partFn, 50000, 3.54)
 
@@ -97,6 +130,7 @@ class TestWorkflowCryoDrgn(TestWorkflow):
 
         protTraining = self._runTraining(protPreprocess2, numEpochs=3, zDim=2)
         self.assertIsNotNone(protTraining._possibleOutputs.Particles.name)
+        self._testVolumeWorker(protTraining)
 
         protAbinitio = self._runAbinitio(protPreprocess2, "hetero",
                                          numEpochs=2, zDim=2)
@@ -108,3 +142,52 @@ class TestWorkflowCryoDrgn(TestWorkflow):
 
         protAnalyze = self._runAnalyze(protTraining)
         self.assertIsNotNone(protAnalyze._possibleOutputs.Volumes.name)
+        self.assertSetSize(protAnalyze.Classes, 20)
+
+        protAnalyze2 = self._runAnalyze(protTraining, analysisBackend=1,
+                                        doLandscape=True, landscapeBackend=1,
+                                        numVols=50, numClusters=5,
+                                        sweepClusters="3 4", sweepLinkages=True,
+                                        doStack=True, trajectorySampling=1,
+                                        trajectoryBudget=8, doProxies=True,
+                                        proxyBoxSize=32,
+                                        objLabel="scalable analysis")
+        self.assertSetSize(protAnalyze2.Classes, 20)
+        self.assertTrue(hasattr(protAnalyze2, "Particles_state01"))
+        self.assertIsNotNone(protAnalyze2.getArtifact('state_ind', state=1))
+        self.assertIsNotNone(protAnalyze2.getArtifact('volumes', group='kmeans')['stack'])
+
+        protTransform = self.newProtocol(CryoDrgnProtTransformVolumes,
+                                         doFlip=True, doDownsample=True,
+                                         boxSize=32)
+        protTransform.inputVolumes.set(protAnalyze.Volumes)
+        self.launchProtocol(protTransform)
+        self.assertSetSize(protTransform.Volumes, 20)
+
+        protLatentSubset = self.newProtocol(CryoDrgnProtLatentSubset,
+                                            numParticles=100)
+        protLatentSubset.inputProt.set(protTraining)
+        protLatentSubset.inputVolumes.set(protAnalyze.Volumes)
+        self.launchProtocol(protLatentSubset)
+        self.assertSetSize(protLatentSubset.Particles_01, 100)
+
+        protFilter = self.newProtocol(CryoDrgnProtFilter)
+        protFilter.inputProt.set(protTraining)
+        self.launchProtocol(protFilter)
+        self.assertEqual(protFilter.Particles.getSize() +
+                         protFilter.ParticlesRejected.getSize(),
+                         protTraining.Particles.getSize())
+
+        # with 3 epochs and stride 3, the last epoch is added to the first
+        protConvergence = self._runConvergence(protTraining, numAnchors=5,
+                                               epochStride=3)
+        self.assertTrue(protConvergence.isFinished())
+        protConvergence._createFilenameTemplates()
+        with open(protConvergence._getFileName('report')) as f:
+            report = json.load(f)
+        self.assertEqual([m['epoch'] for m in report], [1, 3])
+        for key in ['plot_latent', 'plot_neighbors', 'plot_volumes']:
+            self.assertTrue(os.path.exists(protConvergence._getFileName(key)))
+        for epoch in [0, 2]:
+            self.assertTrue(os.path.exists(
+                protConvergence._getFileName('z_anchors', epoch=epoch)))
@@ -1,24 +1,717 @@
 import os
+import json
+import pickle
+import time
+import shutil
+import socket
+import secrets
+import fcntl
+import hashlib
+import tempfile
+import threading
+import subprocess
+from urllib.parse import quote
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import mrcfile
 import numpy as np
 
 from pyworkflow.utils.process import runJob
 from cryodrgn import Plugin
+from cryodrgn.constants import (CRYODRGN_VOLUME_CACHE,
+                                CRYODRGN_VOLUME_CACHE_SIZE)
 
 
 def generateVolumes(zValues, weights, config, outdir, apix=1, flip=False,
-                    downsample=None, invert=False):
+                    downsample=None, invert=False, useWorker=False, gpus='0'):
     """
     Function to call cryodrgn eval_vol and generate new volumes
+    outdir/vol_NNN.mrc, one per row of zValues.
+    Volumes found in the VolumeCache are not decoded again.
+    If useWorker is True, volumes are decoded by a persistent
+    VolumeWorker that keeps the model loaded between calls.
+    """
+    z = _getZArray(zValues)
+    params = dict(apix=apix, flip=flip, downsample=downsample, invert=invert)
+    cache = VolumeCache.fromConfig()
+    missing = list(range(len(z)))
+
+    if cache is not None:
+        missing = cache.restore(z, weights, config, outdir, **params)
+        if not missing:
+            return
+
+    if len(missing) == len(z):
+        _decodeVolumes(z, weights, config, outdir, useWorker, gpus, **params)
+    else:
+        # decode only missing volumes and move them to their final names
+        tmpDir = os.path.join(outdir, 'missing')
+        _decodeVolumes(z[missing], weights, config, tmpDir, useWorker, gpus,
+                       **params)
+        for j, i in enumerate(missing):
+            os.replace(getVolumeName(tmpDir, j), getVolumeName(outdir, i))
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    if cache is not None:
+        cache.store(z[missing], weights, config,
+                    [getVolumeName(outdir, i) for i in missing], **params)
+
+
+def generateAdaptiveTrajectory(zPath, weights, config, outdir, budget=20,
+                               tolerance=0.05, numCoarse=5, **kwargs):
+    """
+    Generate volumes along the piecewise linear latent path through the
+    rows of zPath. Starting from numCoarse evenly spaced points, intervals
+    whose neighbor volumes differ by more than tolerance (relative L2
+    difference) are bisected, largest differences first, until none
+    exceeds it or budget volumes were generated. Volumes are written as
+    outdir/vol_NNN.mrc in path order, their z values to outdir/z_values.txt.
+    Other keyword arguments are passed to generateVolumes.
+    :return: the z values of the generated volumes
+    """
+    zPath = _getZArray(zPath)
+    steps = np.linalg.norm(np.diff(zPath, axis=0), axis=1)
+    length = np.concatenate([[0], np.cumsum(steps)])
+    length = length / length[-1] if length[-1] > 0 else length
+
+    def _interpolate(t):
+        return np.stack([np.interp(t, length, zPath[:, d])
+                         for d in range(zPath.shape[1])], axis=-1)
+
+    files, diffs, rounds = dict(), dict(), 0
+    newT = list(np.linspace(0, 1, max(2, min(numCoarse, budget))))
+
+    while newT:
+        roundDir = os.path.join(outdir, f'round{rounds:02d}')
+        generateVolumes(_interpolate(np.asarray(newT)), weights, config,
+                        roundDir, **kwargs)
+        files.update((t, getVolumeName(roundDir, i)) for i, t in enumerate(newT))
+        rounds += 1
+
+        # differences between neighbors, computed once per interval
+        ts = sorted(files)
+        diffs = {(left, right): diffs[(left, right)] if (left, right) in diffs
+                 else _getVolumeDiff(files[left], files[right])
+                 for left, right in zip(ts[:-1], ts[1:])}
+
+        candidates = sorted(((d, pair) for pair, d in diffs.items()
+                             if d > tolerance), reverse=True)
+        newT = [(left + right) / 2 for _, (left, right)
+                in candidates[:budget - len(files)]]
+
+    ts = sorted(files)
+    os.makedirs(outdir, exist_ok=True)
+    for i, t in enumerate(ts):
+        os.replace(files[t], getVolumeName(outdir, i))
+    for r in range(rounds):
+        shutil.rmtree(os.path.join(outdir, f'round{r:02d}'), ignore_errors=True)
+
+    zValues = _interpolate(np.asarray(ts))
+    np.savetxt(os.path.join(outdir, 'z_values.txt'), zValues)
+
+    return zValues
+
+
+def _getVolumeDiff(fn1, fn2):
+    """ Relative L2 difference between two volumes. """
+    with mrcfile.mmap(fn1, mode='r', permissive=True) as mrc1, \
+            mrcfile.mmap(fn2, mode='r', permissive=True) as mrc2:
+        vol1 = np.asarray(mrc1.data, dtype=np.float64)
+        vol2 = np.asarray(mrc2.data, dtype=np.float64)
+        norm = max(np.linalg.norm(vol1), np.linalg.norm(vol2))
+
+        return float(np.linalg.norm(vol1 - vol2) / norm) if norm else 0.
+
+
+def getVolumeName(outdir, index):
+    """ Return the volume file name written by eval_vol. """
+    return os.path.join(outdir, f"vol_{index:03d}.mrc")
+
+
+def getVolumeStackName(outdir):
+    """ Return the volume stack file name written by stackVolumes. """
+    return os.path.join(outdir, "volumes.mrcs")
+
+
+def stackVolumes(outdir, count):
+    """ Consolidate outdir/vol_NNN.mrc files into a single volume
+    stack outdir/volumes.mrcs and remove them. Volumes are copied one
+    at a time into the memory-mapped stack.
+    :return: the stack file name
     """
-    program = 'eval_vol'
-    args = _getEvalVolArgs(zValues, weights, config, outdir, apix, flip,
-                           downsample, invert)
-    runJob(None, Plugin.getProgram(program, gpus='0'), ' '.join(args),
-           env=Plugin.getEnviron())
+    files = [getVolumeName(outdir, i) for i in range(count)]
+    stackFn = getVolumeStackName(outdir)
+    tmpFn = stackFn + ".tmp"
+
+    with mrcfile.mmap(files[0], mode='r', permissive=True) as mrc:
+        shape, voxelSize = mrc.data.shape, mrc.voxel_size
+
+    with mrcfile.new_mmap(tmpFn, shape=(count, *shape), mrc_mode=2,
+                          overwrite=True) as stack:
+        for i, fn in enumerate(files):
+            with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+                stack.data[i] = mrc.data
+        stack.voxel_size = voxelSize
+
+    os.replace(tmpFn, stackFn)
+    for fn in files:
+        os.remove(fn)
+
+    return stackFn
+
+
+def getVolumeLocations(outdir):
+    """ Return the locations of the volumes in outdir: (index, stack)
+    if they were stacked, otherwise vol_NNN.mrc file names. """
+    stackFn = getVolumeStackName(outdir)
+    if os.path.exists(stackFn):
+        with mrcfile.open(stackFn, header_only=True, permissive=True) as mrc:
+            count = int(mrc.header.nz // max(int(mrc.header.mz), 1))
+        return [(i + 1, stackFn) for i in range(count)]
+
+    locations = []
+    while os.path.exists(getVolumeName(outdir, len(locations))):
+        locations.append(getVolumeName(outdir, len(locations)))
+
+    return locations
+
 
+def readVolume(location):
+    """ Read a volume from a file name or an (index, stack) location. """
+    index, fn = location if isinstance(location, tuple) else (0, location)
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data[index - 1] if mrc.is_volume_stack() else mrc.data
+        return np.array(data, dtype=np.float32)
 
-def _getEvalVolArgs(zvalues, weights, config, outdir, apix, flip,
-                    downsample, invert):
+
+def fourierCrop(vol, boxSize):
+    """ Crop the centered Fourier transform to boxSize, keeping the
+    real space intensity scale. """
+    origBox = vol.shape[0]
+    if boxSize == origBox:
+        return vol
+
+    start = origBox // 2 - boxSize // 2
+    crop = slice(start, start + boxSize)
+    ft = np.fft.fftshift(np.fft.fftn(vol))[crop, crop, crop]
+    vol = np.fft.ifftn(np.fft.ifftshift(ft)).real
+
+    return (vol * (boxSize / origBox) ** 3).astype(np.float32)
+
+
+def getProxyName(outdir, index):
+    """ Return the low resolution proxy name of volume index. """
+    return getVolumeName(os.path.join(outdir, "proxy"), index)
+
+
+def makeProxies(outdir, boxSize=64, threads=4):
+    """
+    Write Fourier cropped low resolution proxies of the volumes of
+    outdir as outdir/proxy/vol_NNN.mrc, on a thread pool.
+    :return: the proxy file names
+    """
+    os.makedirs(os.path.join(outdir, "proxy"), exist_ok=True)
+
+    def _makeProxy(job):
+        i, location = job
+        index, fn = location if isinstance(location, tuple) else (0, location)
+        with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+            apix = float(mrc.voxel_size.x)
+        vol = readVolume(location)
+        proxy = fourierCrop(vol, min(boxSize, vol.shape[0]))
+        proxyFn = getProxyName(outdir, i)
+        with mrcfile.new(proxyFn, overwrite=True) as mrc:
+            mrc.set_data(proxy)
+            mrc.voxel_size = apix * vol.shape[0] / proxy.shape[0]
+        return proxyFn
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(_makeProxy,
+                                 enumerate(getVolumeLocations(outdir))))
+
+
+def getThumbnailName(outdir, page):
+    return os.path.join(outdir, "thumbnails", f"mosaic_{page:02d}.png")
+
+
+def makeThumbnails(outdir, size=64, perPage=50, threads=4):
+    """
+    Render the volumes of outdir into PNG mosaics
+    outdir/thumbnails/mosaic_NN.png. Each row is one volume: central
+    slices and projections along z, y and x. Volumes are read one at a
+    time on a thread pool, and each page is saved before the next one
+    is rendered.
+    :return: the mosaic file names
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    locations = getVolumeLocations(outdir)
+    os.makedirs(os.path.join(outdir, "thumbnails"), exist_ok=True)
+    files = []
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for page, start in enumerate(range(0, len(locations), perPage)):
+            rows = list(executor.map(lambda loc: _getThumbnailRow(loc, size),
+                                     locations[start:start + perPage]))
+            fn = getThumbnailName(outdir, page)
+            plt.imsave(fn, np.vstack(rows), cmap='gray', vmin=0, vmax=1)
+            files.append(fn)
+
+    return files
+
+
+def _getThumbnailRow(location, size):
+    """ Central slices and projections of a volume, side by side,
+    each resampled to size x size pixels and scaled to [0, 1]. """
+    vol = readVolume(location)
+    center = [d // 2 for d in vol.shape]
+    panels = [vol[center[0]], vol[:, center[1]], vol[:, :, center[2]],
+              vol.sum(axis=0), vol.sum(axis=1), vol.sum(axis=2)]
+
+    row = []
+    for panel in panels:
+        panel = _resamplePanel(panel, size)
+        low, high = np.percentile(panel, (1, 99))
+        row.append(np.clip((panel - low) / (high - low or 1), 0, 1))
+
+    return np.hstack(row)
+
+
+def _resamplePanel(panel, size):
+    """ Resample a 2D panel to exactly size x size, low-pass filtered
+    when downsampling. Rounding differences are cropped or padded
+    evenly on both sides, so the panel stays centred. """
+    from scipy import ndimage
+    factor = size / max(panel.shape)
+    panel = np.asarray(panel, dtype=np.float32)
+    if factor < 1:
+        panel = ndimage.gaussian_filter(panel, sigma=0.5 / factor)
+    panel = ndimage.zoom(panel, factor, order=1, grid_mode=True, mode='nearest')
+
+    for axis in range(2):
+        diff = panel.shape[axis] - size
+        if diff > 0:
+            panel = np.take(panel, range(diff // 2, diff // 2 + size), axis=axis)
+        elif diff < 0:
+            pad = [(0, 0), (0, 0)]
+            pad[axis] = (-diff // 2, -diff - (-diff // 2))
+            panel = np.pad(panel, pad, mode='edge')
+
+    return panel
+
+
+def _decodeVolumes(z, weights, config, outdir, useWorker, gpus, **params):
+    if useWorker:
+        worker = VolumeWorker(weights, config, gpus=gpus)
+        worker.generate(z, outdir, **params)
+    else:
+        program = 'eval_vol'
+        args = _getEvalVolArgs(z, weights, config, outdir, **params)
+        runJob(None, Plugin.getProgram(program, gpus=gpus), ' '.join(args),
+               env=Plugin.getEnviron())
+
+
+def _getZArray(zValues):
+    """ Return z values as a (N, zdim) array. A 1D input is
+    considered as N values of a 1D latent space. """
+    z = np.asarray(zValues, dtype=float)
+    return z[:, None] if z.ndim == 1 else z
+
+
+class VolumeCache:
+    """
+    Content-addressed on-disk cache of generated volumes. Volumes are keyed
+    by the weights and config content, the z vector and the eval_vol
+    parameters. When the cache grows over maxSize bytes, least recently
+    used volumes (by modification time, updated on every hit) are evicted.
+    """
+    _hashes = dict()
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+
+    @classmethod
+    def fromConfig(cls):
+        """ Return the cache defined by the plugin variables,
+        or None if it is disabled (size 0). """
+        maxSize = float(Plugin.getVar(CRYODRGN_VOLUME_CACHE_SIZE) or 0)
+        if maxSize <= 0:
+            return None
+
+        path = os.path.expanduser(Plugin.getVar(CRYODRGN_VOLUME_CACHE))
+        return cls(path, maxSize * 1024 ** 3)
+
+    def restore(self, z, weights, config, outdir, **params):
+        """ Place cached volumes as outdir/vol_NNN.mrc.
+        :return: indices of z values not found in the cache
+        """
+        os.makedirs(outdir, exist_ok=True)
+        missing = []
+        for i, zz in enumerate(z):
+            fn = self._getPath(self.getKey(zz, weights, config, **params))
+            try:
+                os.utime(fn)  # mark as recently used
+                _placeFile(fn, getVolumeName(outdir, i))
+            except FileNotFoundError:
+                missing.append(i)
+
+        return missing
+
+    def store(self, z, weights, config, files, **params):
+        """ Add generated volumes to the cache and evict old ones. """
+        for zz, volFn in zip(z, files):
+            fn = self._getPath(self.getKey(zz, weights, config, **params))
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            tmpFn = f"{fn}.{os.getpid()}.tmp"
+            shutil.copyfile(volFn, tmpFn)
+            os.replace(tmpFn, fn)
+
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used volumes until under maxSize. """
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.endswith('.mrc'):
+                    fn = os.path.join(root, f)
+                    try:
+                        st = os.stat(fn)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, fn))
+
+        total = sum(e[1] for e in entries)
+        for _, size, fn in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def getKey(self, z, weights, config, apix=1, flip=False,
+               downsample=None, invert=False):
+        h = hashlib.sha1()
+        h.update(self._hashFile(weights).encode())
+        h.update(self._hashFile(config).encode())
+        h.update(np.asarray(z, dtype=np.float64).tobytes())
+        h.update(json.dumps([round(float(apix), 6), bool(flip),
+                             downsample, bool(invert)]).encode())
+
+        return h.hexdigest()
+
+    def _getPath(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.mrc")
+
+    @classmethod
+    def _hashFile(cls, fn):
+        """ Return the content hash of a file, computed once
+        per file version. """
+        st = os.stat(fn)
+        statKey = (os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+        if statKey not in cls._hashes:
+            h = hashlib.sha1()
+            with open(fn, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            cls._hashes[statKey] = h.hexdigest()
+
+        return cls._hashes[statKey]
+
+
+def _placeFile(src, dst):
+    """ Hard link src to dst, or copy it if linking is not possible. """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class VolumeWorker:
+    """
+    Client of a long-lived eval_vol worker (scripts/volume_worker.py)
+    that keeps the model loaded. There is one worker per (weights, config),
+    started on first use and reached over a unix socket. The worker exits
+    by itself after idleTimeout seconds without requests.
+    """
+    START_TIMEOUT = 600
+
+    def __init__(self, weights, config, gpus='0', idleTimeout=600):
+        self.weights = os.path.abspath(weights)
+        self.config = os.path.abspath(config)
+        self.gpus = gpus
+        self.idleTimeout = idleTimeout
+        key = hashlib.sha1(f"{self.weights}:{self.config}:{gpus}".encode()).hexdigest()
+        self.address = os.path.join(tempfile.gettempdir(),
+                                    f"cryodrgn-worker-{os.getuid()}-{key[:16]}.sock")
+
+    def generate(self, zValues, outdir, apix=1, flip=False, downsample=None,
+                 invert=False):
+        """ Decode volumes for zValues into outdir/vol_NNN.mrc.
+        :return: list of generated files
+        """
+        z = np.asarray(zValues, dtype=float)
+        if z.ndim == 1:  # one value per line, as np.savetxt would write
+            z = z[:, None]
+
+        request = {
+            'z': z.tolist(),
+            'outdir': os.path.abspath(outdir),
+            'apix': apix,
+            'flip': flip,
+            'downsample': downsample,
+            'invert': invert
+        }
+        try:
+            reply = self._request(request)
+        except (FileNotFoundError, ConnectionError, ValueError):
+            # no worker, or it exited on idle timeout while we connected
+            self._start()
+            reply = self._request(request)
+
+        if 'error' in reply:
+            raise RuntimeError(f"Volume worker failed: {reply['error']}")
+
+        return reply['files']
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.address)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile('rb') as f:
+                line = f.readline()
+
+        if not line:
+            raise ConnectionError("Volume worker closed the connection")
+
+        return json.loads(line)
+
+    def _isAlive(self):
+        """ Return True if a worker accepts connections on the socket. """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.address)
+                return True
+            except OSError:
+                return False
+
+    def _start(self):
+        """ Launch the worker and wait until the model is loaded. Clients
+        take a lock file, so that only one of them starts the worker and
+        none removes the socket of a worker started meanwhile. """
+        with open(self.address + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._isAlive():  # started by another client
+                return
+
+            if os.path.exists(self.address):  # stale socket of a dead worker
+                os.remove(self.address)
+            self._spawn()
+
+    def _spawn(self):
+        args = [
+            self.weights,
+            f"-c {self.config}",
+            f"--socket {self.address}",
+            f"--idle-timeout {self.idleTimeout}"
+        ]
+        cmd = f"{Plugin.getPythonProgram('volume_worker.py', self.gpus)} {' '.join(args)}"
+        with open(self.address + '.log', 'a') as log:
+            proc = subprocess.Popen(cmd, shell=True, env=Plugin.getEnviron(),
+                                    stdout=log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+
+        start = time.time()
+        while not self._isAlive():
+            if proc.poll() is not None:
+                raise RuntimeError("Volume worker exited, see log "
+                                   f"{self.address}.log")
+            if time.time() - start > self.START_TIMEOUT:
+                raise TimeoutError("Volume worker did not start in "
+                                   f"{self.START_TIMEOUT} s")
+            time.sleep(0.5)
+
+
+class JupyterServer:
+    """
+    Jupyter server of a Scipion project that serves the project folder.
+    Its pid, port and token are saved in the project Tmp folder, so the
+    server is reused by later viewers while it is alive.
+    """
+    START_TIMEOUT = 120
+
+    def __init__(self, projectPath):
+        self.root = os.path.abspath(projectPath)
+        self.infoFile = os.path.join(self.root, 'Tmp', 'cryodrgn_jupyter.json')
+
+    def getUrl(self, notebook):
+        """ Return the url of notebook, starting the server if needed. """
+        info = self._load()
+        if info is None or not self._isAlive(info):
+            info = self._start()
+
+        relPath = os.path.relpath(os.path.abspath(notebook), self.root)
+        return (f"http://localhost:{info['port']}/notebooks/{quote(relPath)}"
+                f"?token={info['token']}")
+
+    def _load(self):
+        try:
+            with open(self.infoFile) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _isAlive(info):
+        """ Return True if the server process runs and listens on its port. """
+        try:
+            os.kill(info['pid'], 0)
+            with socket.create_connection(('localhost', info['port']), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _getFreePort():
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            return sock.getsockname()[1]
+
+    def _start(self):
+        """ Launch the server and wait until it accepts connections. """
+        info = {'port': self._getFreePort(), 'token': secrets.token_hex(24)}
+        args = [
+            "--no-browser",
+            f"--port {info['port']}",
+            f"--notebook-dir {self.root}",
+            f"--NotebookApp.token={info['token']}",  # notebook < 7
+            f"--ServerApp.token={info['token']}"
+        ]
+        cmd = Plugin.getEnvCommand(f"jupyter notebook {' '.join(args)}")
+        os.makedirs(os.path.dirname(self.infoFile), exist_ok=True)
+        logFn = self.infoFile.replace('.json', '.log')
+        with open(logFn, 'a') as log:
+            proc = subprocess.Popen(cmd, shell=True, env=Plugin.getEnviron(),
+                                    stdout=log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        info['pid'] = proc.pid
+
+        start = time.time()
+        while not self._isAlive(info):
+            if proc.poll() is not None:
+                raise RuntimeError(f"Jupyter server exited, see log {logFn}")
+            if time.time() - start > self.START_TIMEOUT:
+                raise TimeoutError("Jupyter server did not start in "
+                                   f"{self.START_TIMEOUT} s")
+            time.sleep(0.5)
+
+        with open(self.infoFile, 'w') as f:
+            json.dump(info, f)
+
+        return info
+
+
+class LatentIndex:
+    """
+    KD-tree over the latent embeddings of one epoch for k-nearest and
+    radius queries. It is built once and pickled next to the training
+    outputs, later loads take milliseconds.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+
+    @classmethod
+    def load(cls, zFile, indexFile):
+        """ Load the index of zFile, building it if missing or stale. """
+        if (os.path.exists(indexFile) and
+                os.path.getmtime(indexFile) >= os.path.getmtime(zFile)):
+            with open(indexFile, 'rb') as f:
+                return cls(pickle.load(f))
+
+        from scipy.spatial import cKDTree
+        with open(zFile, 'rb') as f:
+            tree = cKDTree(np.asarray(pickle.load(f), dtype=np.float32))
+
+        os.makedirs(os.path.dirname(indexFile), exist_ok=True)
+        tmpFn = f"{indexFile}.{os.getpid()}.tmp"
+        with open(tmpFn, 'wb') as f:
+            pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFn, indexFile)
+
+        return cls(tree)
+
+    def __len__(self):
+        return self.tree.n
+
+    def query(self, points, k):
+        """ Return distances and indices of the k nearest particles
+        of each point, as (len(points), k) arrays. """
+        points = np.atleast_2d(points)
+        k = min(k, len(self))
+        dist, ind = self.tree.query(points, k=k, workers=-1)
+        return (np.asarray(dist).reshape(len(points), k),
+                np.asarray(ind).reshape(len(points), k))
+
+    def knn(self, points, k):
+        """ Return the indices of the k nearest particles of each point. """
+        return list(self.query(points, k)[1])
+
+    def radius(self, points, r):
+        """ Return the indices of the particles within r of each point. """
+        return [np.sort(np.asarray(ind, dtype=np.int64)) for ind in
+                self.tree.query_ball_point(np.atleast_2d(points), r, workers=-1)]
+
+
+class PrefetchCache:
+    """
+    Small in-memory LRU cache filled by a background thread pool. Keys
+    are loaded as soon as they are prefetched, get() waits for a pending
+    load instead of reading the file again.
+    """
+    def __init__(self, loader, maxSize=32, threads=4):
+        self.loader = loader
+        self.maxSize = maxSize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(threads)
+
+    def prefetch(self, key):
+        """ Start loading key in the background unless it is cached. """
+        with self._lock:
+            future = self._items.get(key)
+            if future is None:
+                future = self._executor.submit(self.loader, key)
+                self._items[key] = future
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxSize:
+                self._items.popitem(last=False)
+
+        return future
+
+    def get(self, key):
+        """ Return the loaded key. Failed loads are not cached,
+        their exception is raised. """
+        future = self.prefetch(key)
+        try:
+            return future.result()
+        except Exception:
+            with self._lock:
+                if self._items.get(key) is future:
+                    del self._items[key]
+            raise
+
+
+def _getEvalVolArgs(zvalues, weights, config, outdir, apix=1, flip=False,
+                    downsample=None, invert=False):
     os.makedirs(outdir, exist_ok=True)
     np.savetxt(f'{outdir}/zfile.txt', zvalues)
     zfilePath = os.path.abspath(os.path.join(outdir, 'zfile.txt'))
@@ -25,17 +25,27 @@
 # **************************************************************************
 
 import os
+import time
+import pickle
 from glob import glob
+import webbrowser
+from threading import Thread
+import mrcfile
 
 from pyworkflow.protocol.params import (LabelParam, EnumParam,
-                                        BooleanParam, IntParam)
-from pyworkflow.protocol.executor import StepExecutor
+                                        BooleanParam, IntParam, StringParam)
 from pyworkflow.viewer import DESKTOP_TKINTER
+import pyworkflow.utils as pwutils
+from pwem.objects import SetOfVolumes, Volume
 from pwem.viewers import ObjectView, ChimeraView, EmProtocolViewer
 
-from cryodrgn import Plugin
-from cryodrgn.protocols import CryoDrgnProtAnalyze
-from cryodrgn.constants import VOLUME_SLICES, VOLUME_CHIMERA
+from cryodrgn.protocols import (CryoDrgnProtAnalyze, CryoDrgnProtConvergence,
+                                CryoDrgnProtSubset)
+from cryodrgn.explorer import LatentDensityExplorer
+from cryodrgn.constants import VOLUME_SLICES, VOLUME_CHIMERA, VOLUME_THUMBNAILS
+from cryodrgn.utils import (getThumbnailName, getProxyName, getVolumeLocations,
+                            readVolume, getVolumeName, PrefetchCache,
+                            JupyterServer)
 
 
 class CryoDrgnViewer(EmProtocolViewer):
@@ -47,11 +57,14 @@ class CryoDrgnViewer(EmProtocolViewer):
 
     def __init__(self, **kwargs):
         EmProtocolViewer.__init__(self, **kwargs)
+        self._images = PrefetchCache(self._readImage)
+        self._headers = PrefetchCache(self._readHeader, maxSize=64)
+        Thread(target=self._prefetch, daemon=True).start()
 
     def _createFilenameTemplates(self):
         """ Centralize how files are called. """
         if self.protocol.hasMultLatentVars():
-            path = glob(self.protocol.getOutputDir("analyze.*/kmeans*"))[0]
+            path = self._getArtifactPath('kmeans_dir', "analyze.*/kmeans*")
             out = lambda p: os.path.join(path, p)
             self._updateFilenamesDict({
                 'umap': out('umap.png'),
@@ -59,13 +72,14 @@ class CryoDrgnViewer(EmProtocolViewer):
                 'pca': out('z_pca.png'),
                 'pcahex': out('z_pca_hex.png'),
                 'pca_volN': out('../pc%(pc)d/vol_%(id)03d.mrc'),
+                'pca_z': out('../pc%(pc)d/z_values.txt'),
                 'umap_pcN': out('../pc%(pc)d/umap.png'),
                 'umap_pcN_traversal': out('../pc%(pc)d/umap_traversal_connected.png'),
                 'graph_vol': out('../graph_traversal/vol_000.mrc'),
                 'notebook': out('../cryoDRGN_filtering.ipynb')
             })
             if self.protocol.doLandscape:
-                path = glob(self.protocol.getOutputDir("landscape.*"))[0]
+                path = self._getArtifactPath('landscape_dir', "landscape.*")
                 out = lambda p: os.path.join(path, "clustering_L2_%(algorithm)s_%(clusters)d", p)
                 self._updateFilenamesDict({
                     'landscape_vols_vae': out('umap.png'),
@@ -74,7 +88,7 @@ class CryoDrgnViewer(EmProtocolViewer):
                     'landscape_parts_count': out('state_particle_counts.png'),
                 })
         else:
-            path = glob(self.protocol.getOutputDir("analyze.*"))[0]
+            path = self._getArtifactPath('analyze_dir', "analyze.*")
             out = lambda p: os.path.join(path, p)
             self._updateFilenamesDict({
                 'simple_hist': out('z_hist.png'),
@@ -85,10 +99,23 @@ class CryoDrgnViewer(EmProtocolViewer):
     def _defineParams(self, form):
         form.addSection(label='Visualization')
         form.addParam('displayType', EnumParam,
-                      choices=['slices', 'chimera'],
-                      default=VOLUME_SLICES,
+                      choices=['slices', 'chimera', 'thumbnails'],
+                      default=VOLUME_THUMBNAILS if self.protocol.doThumbnails else VOLUME_SLICES,
                       display=EnumParam.DISPLAY_HLIST,
-                      label='Display volumes with')
+                      label='Display volumes with',
+                      help="*thumbnails*: precomputed mosaics, one row per "
+                           "volume with central slices and projections "
+                           "along z, y and x. Full maps are not loaded.")
+        if self.protocol.doProxies:
+            form.addParam('useProxies', BooleanParam, default=True,
+                          condition='displayType==%d' % VOLUME_CHIMERA,
+                          label='Open low resolution proxies?')
+            form.addParam('fullResFrames', StringParam, default='',
+                          condition='displayType==%d and useProxies' % VOLUME_CHIMERA,
+                          label='Full resolution frames',
+                          help="Volume numbers (as in vol_NNN), e.g. *0 5 9*, "
+                               "opened at full resolution next to the "
+                               "proxy series.")
         form.addParam('displayVolKmeans', LabelParam,
                       label='Show K-means volumes',
                       help="Cryodrgn analyze uses the k-means clustering algorithm to "
@@ -130,6 +157,18 @@ class CryoDrgnViewer(EmProtocolViewer):
             group.addParam('doShowPcaToUmapTrav', LabelParam,
                            label="Show UMAP connected traversal along PCX")
 
+            group = form.addGroup('Density explorer')
+            group.addParam('explorerSpace', EnumParam,
+                           choices=['umap', 'pca'], default=0,
+                           display=EnumParam.DISPLAY_HLIST,
+                           label="Coordinates")
+            group.addParam('doShowExplorer', LabelParam,
+                           label="Open interactive density explorer",
+                           help="Zoom into dense regions of the particle "
+                                "density and draw a lasso around particles. "
+                                "*Create subset* launches a particles subset "
+                                "run with the selected particles.")
+
         else:
             form.addParam('doShowDistr', LabelParam,
                           label='Show latent coordinates distribution')
@@ -139,18 +178,30 @@ class CryoDrgnViewer(EmProtocolViewer):
         group = form.addGroup('Jupyter')
         group.addParam('serverMode', BooleanParam, default=False,
                        label='Launch Jupyter in server mode?',
-                       help="If yes, the Jupyter notebook will be initialized "
-                            "with option *--no-browser*.\n"
-                            "Then you might be able to connect to the local server. "
-                            "One can also access the server remotely by setting "
-                            "a SSH tunnel:\n"
-                            "$ ssh -N -f -L localhost:8888:localhost:8888 remote_username@remote_host_name "
-                            "# replace remote_username and remote_host_name with your login information")
+                       help="One Jupyter server is started per project and "
+                            "reused while it runs, on a free port.\n"
+                            "If yes, no browser is opened and the notebook url "
+                            "is shown instead. One can access the server "
+                            "remotely by setting a SSH tunnel:\n"
+                            "$ ssh -N -f -L localhost:PORT:localhost:PORT remote_username@remote_host_name "
+                            "# replace PORT with the port of the url, remote_username and "
+                            "remote_host_name with your login information")
         group.addParam('doShowNotebook', LabelParam,
                        label="Show Jupyter notebook")
 
         if self.protocol.doLandscape and self.protocol.hasMultLatentVars():
             form.addSection(label="Landscape analysis")
+            form.addParam('landscapeLinkage', EnumParam,
+                          choices=['average', 'ward'],
+                          default=self.protocol.linkage.get(),
+                          display=EnumParam.DISPLAY_HLIST,
+                          label="Linkage")
+            form.addParam('landscapeClusters', IntParam,
+                          default=self.protocol.numClusters.get(),
+                          label="Number of clusters",
+                          help="Clustering settings computed: " +
+                               ", ".join(f"{l} {m}" for l, m in
+                                         self.protocol._getClusteringGrid()))
             form.addParam('doShowVolsVae', LabelParam,
                           label='Show volumes colored by cluster '
                                 'label in the VAE latent space')
@@ -176,7 +227,8 @@ class CryoDrgnViewer(EmProtocolViewer):
                 'doShowPCA': lambda paramName: self.showPlots(key='pca'),
                 'doShowUMAP': lambda paramName: self.showPlots(key='umap'),
                 'doShowPcaToUmap': lambda paramName: self.showPlots(key='umap_pcN'),
-                'doShowPcaToUmapTrav': lambda paramName: self.showPlots(key='umap_pcN_traversal')
+                'doShowPcaToUmapTrav': lambda paramName: self.showPlots(key='umap_pcN_traversal'),
+                'doShowExplorer': self.showExplorer
             })
             if self.protocol.doGraphTraversal:
                 visDict['displayVolGraph'] = lambda paramName: self.showVolumes(key='graph')
@@ -202,32 +254,37 @@ class CryoDrgnViewer(EmProtocolViewer):
                 return self.showVolumesChimera(key)
             elif self.displayType == VOLUME_SLICES:
                 return self.showVolumeSlices(key)
+            elif self.displayType == VOLUME_THUMBNAILS:
+                return self.showThumbnails(key)
         except Exception as e:
             self.showError(str(e))
 
     def showVolumesChimera(self, key='kmeans'):
         """ Create a chimera script to visualize selected volumes. """
         prot = self.protocol
-        if key == 'kmeans':
-            vols = list(prot.Volumes.getFiles())
-        elif key == 'pca':
-            vols = self._getVolumesNamesPCA()
-        elif key == 'graph':
-            vols = [self._getFileName('graph_vol')]
-        else:
-            raise KeyError("Unknown volume type")
-
+        volDir = self._getVolumeDir(key)
         cmdFile = prot._getExtraPath('chimera_volumes.cxc')
-        localVol = os.path.relpath(vols[0], prot._getExtraPath())
-
-        if os.path.exists(vols[0]):
-            with open(cmdFile, 'w+') as f:
-                f.write(f"open {os.path.dirname(localVol)}/vol_*.mrc vseries true\n")
-                if key == 'graph':
-                    f.write("vol all color cornflowerblue\n"
-                            "mseries all\n")
+        localPath = lambda p: os.path.relpath(p, prot._getExtraPath())
+        locations = self._getVolumeLocations(key)
+        proxyDir = self._getProxyDir(key)
+
+        if self._useProxies() and proxyDir is not None:
+            openCmd = f"open {localPath(proxyDir)}/vol_*.mrc vseries true\n"
+            openCmd += ''.join(f"open {localPath(fn)}\n"
+                               for fn in self._getFullResFrames(locations))
+        elif locations and isinstance(locations[0], tuple):
+            # volume stack opens as a map series
+            openCmd = f"open {localPath(locations[0][1])} format mrc\n"
+        elif locations:
+            openCmd = f"open {localPath(volDir)}/vol_*.mrc vseries true\n"
         else:
-            raise FileNotFoundError(f"File {vols[0]} not found!")
+            raise FileNotFoundError(f"No volumes found in {volDir}!")
+
+        with open(cmdFile, 'w+') as f:
+            f.write(openCmd)
+            if key == 'graph':
+                f.write("vol all color cornflowerblue\n"
+                        "mseries all\n")
 
         view = ChimeraView(cmdFile)
 
@@ -237,9 +294,16 @@ class CryoDrgnViewer(EmProtocolViewer):
         """ Open a sqlite with all volumes selected for visualization. """
         if key == 'pca':
             path = self.protocol._getExtraPath(f"volumes_pc{self.pcNum}.sqlite")
-            files = self._getVolumesNamesPCA()
-            samplingRate = self.protocol._getOutputSampling()
-            self.createVolumesSqlite(files, path, samplingRate)
+            # volumes are written or replaced in the pc folder,
+            # which updates its modification time
+            sources = [os.path.dirname(self._getFileName('pca_volN', pc=self.pcNum, id=0)),
+                       self._getFileName('pca_z', pc=self.pcNum)]
+            if not self._isUpToDate(path, sources):
+                locations = self._getVolumeLocations('pca')
+                if not locations:
+                    raise FileNotFoundError(f"No volumes found for PC{self.pcNum}!")
+                samplingRate = self.protocol._getOutputSampling()
+                self._createVolumesSqlite(locations, path, samplingRate)
         elif key == 'kmeans':
             path = self.protocol._getExtraPath('volumes.sqlite')
         else:  # only chimerax allowed for graph volumes
@@ -247,70 +311,302 @@ class CryoDrgnViewer(EmProtocolViewer):
 
         return [ObjectView(self._project, self.protocol.strId(), path)]
 
-    def showPlots(self, key):
-        kwargs = dict()
-        if key in ["pca", "umap"] and self.useHexBin:
-            key += "hex"
-        elif key.startswith('umap_pcN'):
-            kwargs['pc'] = self.pcNum
-        elif key.startswith('landscape'):
-            kwargs['algorithm'] = self.protocol.getEnumText('linkage')
-            kwargs['clusters'] = self.protocol.numClusters.get()
+    def showThumbnails(self, key='kmeans'):
+        """ Show the volume mosaics, falling back to slices if
+        they were not created. """
+        pages = self._getThumbnails(key)
+        for page, fn in enumerate(pages):
+            if page + 1 < len(pages):
+                self._images.prefetch(pages[page + 1])
+            self._showImage(fn)
+
+        if not pages:
+            return self.showVolumeSlices(key)
 
-        return self._showPlot(key, **kwargs)
+    def showPlots(self, key):
+        return self._showPlot(*self._getPlotArgs(key))
+
+    def showExplorer(self, paramName=None):
+        space = self.getEnumText('explorerSpace')
+        tilesFn = self.protocol.getArtifactPath('explorer_tiles', space=space)
+        coordsFn = self.protocol.getArtifactPath('explorer_coords', space=space)
+        if tilesFn is None or coordsFn is None:
+            self.showError(f"No {space.upper()} density tiles found for this run!")
+            return
+
+        explorer = LatentDensityExplorer(tilesFn, coordsFn, self._createSubset,
+                                         title=f"{space.upper()} density")
+        explorer.show()
+
+    def _createSubset(self, indices):
+        """ Launch a particles subset run with the selected particles. """
+        fn = self.protocol._getExtraPath(f"explorer_selection_{int(time.time())}.pkl")
+        with open(fn, 'wb') as f:
+            pickle.dump(indices, f)
+
+        prot = self._project.newProtocol(
+            CryoDrgnProtSubset, pklFile=os.path.abspath(fn),
+            objLabel=f"latent selection ({len(indices)} particles)")
+        prot.inputParticles.set(self.protocol)
+        prot.inputParticles.setExtended('Particles')
+        self._project.launchProtocol(prot)
 
     def showNotebook(self, paramName=None):
         """ Open jupyter notebook with results in a browser. """
 
         def _extraWork():
-            program = Plugin.getProgram('').split()[:-1]  # remove cryodrgn command
             fn = self._getFileName('notebook')
+            if not os.path.exists(fn):
+                self.showError(f"Jupyter notebook {fn} not found!")
+                return
+
+            try:
+                url = JupyterServer(self._project.getPath()).getUrl(fn)
+            except Exception as e:
+                self.showError(str(e))
+                return
 
             if self.serverMode:
-                args = '--no-browser --port 8888 '
-            else:
-                args = f"{os.path.basename(fn)}"
-
-            program.append(f"jupyter notebook {args}")
-
-            if os.path.exists(fn):
-                fnDir = os.path.dirname(fn)
-                hostConfig = self.protocol.getHostConfig()
-                executor = StepExecutor(hostConfig)
-                self.protocol.setStepsExecutor(executor)
-                self.protocol.runJob(" ".join(program), '',
-                                     env=Plugin.getEnviron(),
-                                     cwd=fnDir)
+                self.showInfo(f"Jupyter notebook is available at:\n{url}")
             else:
-                self.showError(f"Jupyter notebook {fn} not found!")
+                webbrowser.open(url)
 
-        from threading import Thread
         thread = Thread(target=_extraWork)
         thread.start()
 
     # --------------------------- UTILS functions -----------------------------
-    def _getVolumesNamesPCA(self):
-        """ Get filenames for 10 output volumes along PCX. """
-        names = []
-        vols = [self._getFileName('pca_volN',
-                                  pc=self.pcNum,
-                                  id=i) for i in range(10)]
-        for fn in vols:
-            if os.path.exists(fn):
-                names.append(fn)
-            else:
-                raise FileNotFoundError(f"File {fn} not found!")
+    def _getPlotArgs(self, key):
+        """ Return the template key and its arguments for a plot. """
+        kwargs = dict()
+        if key in ["pca", "umap"] and self.useHexBin:
+            key += "hex"
+        elif key.startswith('umap_pcN'):
+            kwargs['pc'] = self.pcNum
+        elif key.startswith('landscape'):
+            kwargs['algorithm'] = self.getEnumText('landscapeLinkage')
+            kwargs['clusters'] = self.landscapeClusters.get()
 
-        return names
+        return key, kwargs
 
-    def _showPlot(self, fn, **kwargs):
+    def _getPrefetchFiles(self):
+        """ Return the plots and the volume files whose headers
+        are read when the viewer opens. """
+        if self.protocol.hasMultLatentVars():
+            keys = ['pca', 'umap', 'umap_pcN', 'umap_pcN_traversal']
+        else:
+            keys = ['simple_dist', 'simple_hist']
+        if self.protocol.doLandscape:
+            keys.extend(['landscape_vols_vae', 'landscape_vols_vae_annot',
+                         'landscape_vols_count', 'landscape_parts_count'])
+        plots = [self._getFileName(key, **kwargs)
+                 for key, kwargs in map(self._getPlotArgs, keys)]
+
+        volKeys = ['kmeans']
+        if self.protocol.hasMultLatentVars():
+            volKeys.append('pca')
+        volumes = []
+        for key in volKeys:
+            plots.extend(self._getThumbnails(key)[:1])
+            locations = self._getVolumeLocations(key)
+            if locations:
+                location = locations[0]
+                volumes.append(location[1] if isinstance(location, tuple) else location)
+
+        return plots, volumes
+
+    def _prefetch(self):
+        """ Read plots and volume headers in the background, so that
+        they are shown without waiting on the file system. """
+        try:
+            self._createFilenameTemplates()
+            plots, volumes = self._getPrefetchFiles()
+        except Exception:  # nothing to prefetch, files are read on demand
+            return
+
+        for fn in plots:
+            self._images.prefetch(fn)
+        for fn in volumes:
+            self._headers.prefetch(fn)
+
+    @staticmethod
+    def _readImage(fn):
         import matplotlib.image as mpimg
-        import matplotlib.pyplot as plt
-        fn = self._getFileName(fn, **kwargs)
-        if os.path.exists(fn):
-            img = mpimg.imread(fn)
-            imgplot = plt.imshow(img)
-            plt.axis('off')
-            plt.show()
+        return mpimg.imread(fn)
+
+    @staticmethod
+    def _readHeader(fn):
+        with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+            return mrc.header.copy()
+
+    def _getVolumeParams(self, key):
+        """ Return the manifest parameters of the k-means,
+        PCX or graph volumes. """
+        if key == 'pca':
+            return {'group': 'pc', 'pc': self.pcNum.get()}
+
+        return {'group': key}
+
+    def _getVolumeLocations(self, key):
+        """ Return the volume locations listed in the manifest: (index,
+        stack) if volumes were stacked, otherwise file names. Runs from
+        older versions have no manifest, their folder is scanned. """
+        if not self.protocol.hasManifest():
+            return getVolumeLocations(self._getVolumeDir(key))
+
+        volumes = self.protocol.getArtifact('volumes', **self._getVolumeParams(key))
+        if volumes is None:
+            return []
+        if volumes['stack']:
+            return [(i + 1, volumes['stack']) for i in range(volumes['count'])]
+
+        return [getVolumeName(volumes['path'], i) for i in range(volumes['count'])]
+
+    def _getThumbnails(self, key):
+        """ Return the thumbnail mosaics of the volumes, in page order. """
+        if self.protocol.hasManifest():
+            return [artifact['path'] for artifact in self.protocol.getArtifacts(
+                'thumbnail', **self._getVolumeParams(key))]
+
+        volDir, pages = self._getVolumeDir(key), []
+        while os.path.exists(getThumbnailName(volDir, len(pages))):
+            pages.append(getThumbnailName(volDir, len(pages)))
+
+        return pages
+
+    def _getProxyDir(self, key):
+        """ Return the folder of the volume proxies, or None. """
+        if self.protocol.hasManifest():
+            return self.protocol.getArtifactPath('proxy_dir',
+                                                 **self._getVolumeParams(key))
+
+        volDir = self._getVolumeDir(key)
+        if os.path.exists(getProxyName(volDir, 0)):
+            return os.path.dirname(getProxyName(volDir, 0))
+
+        return None
+
+    def _useProxies(self):
+        return self.protocol.doProxies and self.useProxies
+
+    def _getFullResFrames(self, locations):
+        """ Return full resolution files of the selected frames. Frames
+        of a volume stack are extracted to single files. """
+        frames = [int(f) for f in self.fullResFrames.get('').split()]
+        if not frames:
+            return []
+
+        files = []
+        for frame in frames:
+            location = locations[frame]
+            if isinstance(location, tuple):
+                fn = self.protocol._getExtraPath(f"chimera_frame_{frame:03d}.mrc")
+                header = self._headers.get(location[1])
+                apix = float(header.cella.x / header.mx)
+                with mrcfile.new(fn, overwrite=True) as mrc:
+                    mrc.set_data(readVolume(location))
+                    mrc.voxel_size = apix
+                location = fn
+            files.append(location)
+
+        return files
+
+    def _getVolumeDir(self, key):
+        """ Return the folder of the k-means, PCX or graph volumes. """
+        path = self.protocol.getArtifactPath('volumes', **self._getVolumeParams(key))
+        if path is not None:
+            return path
+
+        if key == 'kmeans':
+            return os.path.dirname(next(iter(self.protocol.Volumes.getFiles())))
+        elif key == 'pca':
+            return os.path.dirname(self._getFileName('pca_volN',
+                                                     pc=self.pcNum, id=0))
+        elif key == 'graph':
+            return os.path.dirname(self._getFileName('graph_vol'))
         else:
+            raise KeyError("Unknown volume type")
+
+    def _getArtifactPath(self, kind, pattern):
+        """ Resolve a folder from the analysis manifest. Runs from older
+        versions have no manifest, search the output folder instead. """
+        path = self.protocol.getArtifactPath(kind)
+        if path is None:
+            path = glob(self.protocol.getOutputDir(pattern))[0]
+
+        return path
+
+    @staticmethod
+    def _isUpToDate(path, sources):
+        """ Return True if path exists and is newer than all sources. """
+        try:
+            mtime = os.path.getmtime(path)
+            return all(os.path.getmtime(src) <= mtime for src in sources)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _createVolumesSqlite(locations, path, samplingRate):
+        pwutils.cleanPath(path)
+        volSet = SetOfVolumes(filename=path)
+        volSet.setSamplingRate(samplingRate)
+        for location in locations:
+            vol = Volume()
+            vol.setLocation(location)
+            volSet.append(vol)
+        volSet.write()
+        volSet.close()
+
+    def _showPlot(self, fn, **kwargs):
+        fn = self._getFileName(fn, **kwargs)
+        try:
+            self._showImage(fn)
+        except FileNotFoundError:
             self.showError(f"File {fn} not found!")
+
+    def _showImage(self, fn):
+        """ Show an image, prefetched images are taken from memory. """
+        import matplotlib.pyplot as plt
+        img = self._images.get(fn)
+        plt.figure()
+        plt.imshow(img)
+        plt.title(os.path.basename(fn))
+        plt.axis('off')
+        plt.show()
+
+
+class CryoDrgnConvergenceViewer(CryoDrgnViewer):
+    """ Visualization of cryoDRGN convergence analysis. """
+
+    _targets = [CryoDrgnProtConvergence]
+    _label = 'convergence results'
+
+    def _createFilenameTemplates(self):
+        prot = self.protocol
+        prot._createFilenameTemplates()
+        self._updateFilenamesDict({
+            key: prot._getFileName(key)
+            for key in ['plot_latent', 'plot_neighbors', 'plot_volumes']
+        })
+
+    def _defineParams(self, form):
+        form.addSection(label='Visualization')
+        form.addParam('doShowLatent', LabelParam,
+                      label='Show latent distance to the last epoch')
+        form.addParam('doShowNeighbors', LabelParam,
+                      label='Show neighborhood stability')
+        if self.protocol.doVolumes:
+            form.addParam('doShowVolumes', LabelParam,
+                          label='Show volume correlation at anchor points')
+
+    def _getVisualizeDict(self):
+        self._createFilenameTemplates()
+
+        return {
+            'doShowLatent': lambda paramName: self._showPlot('plot_latent'),
+            'doShowNeighbors': lambda paramName: self._showPlot('plot_neighbors'),
+            'doShowVolumes': lambda paramName: self._showPlot('plot_volumes')
+        }
+
+    def _getPrefetchFiles(self):
+        return [self._getFileName(key) for key in
+                ['plot_latent', 'plot_neighbors', 'plot_volumes']], []